@@ -1,60 +1,175 @@
 import logging
 import json
+import gzip
 import requests
-import math
-import copy
+import hashlib
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import azure.functions as func
+from shared_code import blob_stream, checkpoint, http_client, metrics, pagination, snapshot, throttle, tokens, work_queue
 from azure.storage.blob import BlobServiceClient
 from azure.core.exceptions import ResourceNotFoundError
 
 ALLOWED_ADMIN_GROUPS = {"Administrators", "Administrateurs", "Administradores", "Gli amministratori", "Beheerders", "Administratorzy"}
 
-def logon_to_cyberark():
-    logon_query_url = "https://<IIS_Server_Ip>/PasswordVault/API/auth/Cyberark/Logon/"
+CYBERARK_BASE_URL = os.environ.get("CYBERARK_BASE_URL", "https://<IIS_Server_Ip>/PasswordVault/API")
+
+# Maximum number of account detail requests in flight at the same time
+MAX_WORKERS = int(os.environ.get("CYBERARK_MAX_WORKERS", "16"))
+
+# Seconds a CyberArk session token is used before logging on again
+TOKEN_LIFETIME = int(os.environ.get("CYBERARK_TOKEN_LIFETIME", "900"))
+
+# Maximum number of listing pages fetched at the same time
+PAGE_WORKERS = int(os.environ.get("CYBERARK_PAGE_WORKERS", "8"))
+
+# Refetch the details of every account instead of only new and changed ones
+FULL_RESYNC = os.environ.get("CYBERARK_FULL_RESYNC", "false").lower() == "true"
+
+# Seconds one invocation may spend crawling account details before it checkpoints and stops, 0 means no limit
+RUN_BUDGET_SECONDS = int(os.environ.get("CYBERARK_RUN_BUDGET_SECONDS", "0"))
+
+# Number of fetched accounts persisted together in one checkpoint shard
+CHECKPOINT_INTERVAL = int(os.environ.get("CYBERARK_CHECKPOINT_INTERVAL", "1000"))
+
+CHECKPOINT_PREFIX = "checkpoints/discovered_accounts"
+
+# Accounts per shard when the crawl is fanned out to queue-triggered worker invocations, 0 crawls in this invocation
+FANOUT_SHARD_SIZE = int(os.environ.get("CYBERARK_FANOUT_SHARD_SIZE", "0"))
+
+# "storage" for the Azure Storage queue read by CyberArkDiscoveredAccountsWorker, or "sqlite:<path>" to run shards locally
+FANOUT_QUEUE_BACKEND = os.environ.get("CYBERARK_FANOUT_QUEUE_BACKEND", "storage")
+
+# Local worker threads draining the SQLite queue, in Azure the queue trigger scales the workers
+FANOUT_WORKERS = int(os.environ.get("CYBERARK_FANOUT_WORKERS", "4"))
+
+FANOUT_QUEUE_NAME = "cyberark-discovered-shards"
+
+FANOUT_PREFIX = "fanout/discovered_accounts"
+
+# Fields that identify a dependency, two dependencies with the same values are the same dependency
+DEPENDENCY_KEY_FIELDS = ('type', 'address', 'name', 'taskFolder')
+
+# Compressed snapshot of account details keyed by account id, with the listing fingerprints in its index
+ACCOUNT_SNAPSHOT_NAME = "discovered_accounts_snapshot"
+
+def get_cyberark_client(run_metrics=None):
+    # The pooled session is shared across warm invocations, sized to the detail fetch concurrency
+    # Requests are paced per endpoint family, the concurrency limit adapts to how the PVWA copes
+    # The policy is shared with CyberArkSafeMemberAccess, its settings come from CYBERARK_THROTTLE_CONFIG, see shared_code/throttle.py
+    throttle_policy = throttle.get_policy(("cyberark", CYBERARK_BASE_URL), throttle.CYBERARK_THROTTLE_CONFIG)
+    cyberark_client = http_client.ApiClient(CYBERARK_BASE_URL, "cyberark", pool_size=max(MAX_WORKERS, PAGE_WORKERS), run_metrics=run_metrics, throttle_policy=throttle_policy)
+    # The token is cached across warm invocations and refreshed shortly before it expires or after a 401
+    token_key = ("cyberark", CYBERARK_BASE_URL, os.environ["CYBERARK_API_USERNAME"])
+    cyberark_client.token_provider = tokens.get_provider(token_key, lambda: (logon_to_cyberark(cyberark_client), TOKEN_LIFETIME))
+    return cyberark_client
+
+def logon_to_cyberark(cyberark_client):
     logon_json_values = {'username': os.environ["CYBERARK_API_USERNAME"], 'password': os.environ["CYBERARK_API_PASSWORD"]}
-    cyberark_api_token = requests.post(logon_query_url, json=logon_json_values).json()
+    with cyberark_client.metrics.span("logon"):
+        logon_response = cyberark_client.post("auth/Cyberark/Logon/", json=logon_json_values, authenticate=False)
+    if logon_response.status_code != 200:
+        raise requests.HTTPError(f"Failed to log on to CyberArk: HTTP {logon_response.status_code}")
+    cyberark_api_token = logon_response.json()
     logging.info("Obtained Authorization Token Key from CyberArk")
     return cyberark_api_token
 
-def get_current_account_count(cyberark_api_token):
-    account_count_url = "https://<IIS_Server_Ip>/PasswordVault/API/DiscoveredAccounts"
-    account_count_response = requests.get(account_count_url, headers={'Authorization': cyberark_api_token}).json()
-    offset = math.floor(account_count_response["count"] / 1000)
-    logging.info(f"Calculated offset: {offset}")
-    return offset
-
-def get_current_account_id_list(cyberark_api_token, offset):
-  # Current Account ID list 
-  current_account_id_list = set()
-  current_offset = 0
-  while current_offset <= offset:
-     account_id_url = f"https://<IIS_Server_Ip>/PasswordVault/API/DiscoveredAccounts?offset={1000 * current_offset}&limit=1000"
-     account_id_response = requests.get(account_id_url, headers={'Authorization': cyberark_api_token}).json()
-     for account in account_id_response["value"]:
+def get_current_account_count(cyberark_client):
+    account_count = pagination.get_count(cyberark_client, "DiscoveredAccounts")
+    logging.info(f"Current account count: {account_count}")
+    return account_count
+
+def account_fingerprint(account):
+    # Hash of the listing fields (including lastUpdatedTime) which changes whenever CyberArk rescans the account
+    return hashlib.sha1(json.dumps(account, sort_keys=True).encode('utf-8')).hexdigest()
+
+def get_current_account_id_list(cyberark_client, account_count, current_account_fingerprints=None):
+    # Current Account ID list 
+    current_account_id_list = set()
+    for account in pagination.get_all_pages(cyberark_client, "DiscoveredAccounts", account_count, max_workers=PAGE_WORKERS):
         current_account_id_list.add(account["id"])
-     current_offset+=1
-  logging.info("Obtained current account id list from CyberArk")
-  return current_account_id_list
+        if current_account_fingerprints is not None:
+            current_account_fingerprints[account["id"]] = account_fingerprint(account)
+    logging.info("Obtained current account id list from CyberArk")
+    return current_account_id_list
 
-def get_account_details(cyberark_api_token, old_account_id_list, old_account_details, new_account_id_list, current_account_id_list, current_account_details, new_account_details, updated_old_account_details):
-    
-    for current_account_id in current_account_id_list:
-        account_details_url = f"https://<IIS_Server_Ip>/PasswordVault/API/DiscoveredAccounts/{current_account_id}"
-        account_details_response = requests.get(account_details_url, headers={'Authorization': cyberark_api_token})
-        if account_details_response.status_code == 200:
-            account_details_response_json = account_details_response.json()
+def fetch_account_details(cyberark_client, account_id):
+    account_details_response = cyberark_client.get(f"DiscoveredAccounts/{account_id}", endpoint="DiscoveredAccounts/{id}")
+    if account_details_response.status_code != 200:
+        raise requests.HTTPError(f"Failed to fetch details for account ID {account_id}: HTTP {account_details_response.status_code}")
+    return account_details_response.json()
+
+def get_account_details(cyberark_client, old_account_id_list, old_account_details, new_account_id_list, current_account_id_list, current_account_details, new_account_details, updated_old_account_details, max_workers=MAX_WORKERS, account_checkpoint=None, deadline=None, current_account_fingerprints=None):
+    # Account IDs whose details could not be retrieved in this run
+    failed_account_id_list = set()
+    completed = True
+    run_metrics = cyberark_client.metrics
+
+    # Fan the detail requests out and process each account as soon as its response arrives
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(fetch_account_details, cyberark_client, account_id): account_id for account_id in current_account_id_list}
+        for future in as_completed(futures):
+            current_account_id = futures[future]
+            try:
+                account_details_response_json = future.result()
+            except (requests.RequestException, ValueError) as e:
+                logging.warning(f"Error fetching details for account ID {current_account_id}: {str(e)}")
+                failed_account_id_list.add(current_account_id)
+                continue
             current_account_details[current_account_id] = account_details_response_json
+            new_account_count, updated_old_account_count = len(new_account_details), len(updated_old_account_details)
             if old_account_id_list and old_account_details:
-                current_account = copy.deepcopy(account_details_response_json)
-                if current_account_id in new_account_id_list:
-                    process_new_accounts(current_account, new_account_details)
-                elif current_account_id in old_account_id_list:
-                    process_old_account(current_account, old_account_details[current_account_id], updated_old_account_details)
-            logging.info(f"Retrieved Account details: {current_account_id}")
-        else:
-            logging.warning(f"Error fetching details for account ID {current_account_id}: HTTP {account_details_response.status_code}")
-            raise requests.HTTPError(f"Failed to fetch details for account ID {current_account_id}: HTTP {account_details_response.status_code}")
+                # The process functions copy an account only when they emit it
+                current_account = account_details_response_json
+                with run_metrics.span("diff"):
+                    if current_account_id in new_account_id_list:
+                        process_new_accounts(current_account, new_account_details)
+                    elif current_account_id in old_account_details:
+                        process_old_account(current_account, old_account_details[current_account_id], updated_old_account_details)
+            run_metrics.log_item("account", f"Retrieved Account details: {current_account_id}")
+
+            # Persist the account with whatever it emitted so a later invocation can skip it, as long as its listing is unchanged
+            if account_checkpoint is not None:
+                account_checkpoint.add(current_account_id, {
+                    'fingerprint': (current_account_fingerprints or {}).get(current_account_id),
+                    'details': account_details_response_json,
+                    'new': new_account_details[new_account_count:],
+                    'updated': updated_old_account_details[updated_old_account_count:],
+                })
+                if account_checkpoint.pending_count >= CHECKPOINT_INTERVAL:
+                    account_checkpoint.flush()
+
+            if deadline is not None and time.monotonic() >= deadline:
+                logging.warning("Run budget exhausted, stopping the crawl")
+                for pending_future in futures:
+                    pending_future.cancel()
+                completed = False
+                break
+
+    run_metrics.count("accounts_fetched", len(current_account_details))
+    run_metrics.count("accounts_failed", len(failed_account_id_list))
+    if failed_account_id_list:
+        logging.warning(f"Failed to retrieve details for {len(failed_account_id_list)} of {len(current_account_id_list)} accounts")
+    return failed_account_id_list, completed
+
+def load_account_checkpoint(blob_connection_string):
+    return checkpoint.Checkpoint.load(get_account_container_client(blob_connection_string), CHECKPOINT_PREFIX)
+
+def restore_from_checkpoint(account_checkpoint, current_account_fingerprints, current_account_details, new_account_details, updated_old_account_details):
+    # Accounts finished by earlier invocations, returns the restored account ids
+    # Accounts no longer listed in CyberArk are dropped, and accounts whose listing changed since they were checkpointed are fetched again
+    restored_account_id_list = set()
+    for account_id, record in account_checkpoint.items():
+        if account_id in current_account_fingerprints and record.get('fingerprint') == current_account_fingerprints[account_id]:
+            current_account_details[account_id] = record['details']
+            new_account_details.extend(record['new'])
+            updated_old_account_details.extend(record['updated'])
+            restored_account_id_list.add(account_id)
+    stale_count = len(account_checkpoint.done) - len(restored_account_id_list)
+    if stale_count:
+        logging.info(f"Not restoring {stale_count} checkpointed accounts that changed or are no longer listed")
+    return restored_account_id_list
 
 def process_new_accounts(current_account, new_account_details):
     os_groups = current_account.get('osGroups', '').split(',')
@@ -64,9 +179,17 @@ def process_new_accounts(current_account, new_account_details):
     if has_new_dependencies or is_added_to_admin_group:
         if is_added_to_admin_group:
             admin_groups = [group.strip() for group in os_groups if group.strip() in ALLOWED_ADMIN_GROUPS]
-            current_account['osGroups'] = ', '.join(admin_groups)
+            current_account = {**current_account, 'osGroups': ', '.join(admin_groups)}
         new_account_details.append(current_account)
 
+def dependency_key(dependency):
+    return tuple(dependency.get(field) for field in DEPENDENCY_KEY_FIELDS)
+
+def get_new_dependencies(current_account_dependencies, old_account_dependencies):
+    # Hash-set diff on the identifying fields instead of comparing every pair of dependency dicts
+    old_dependency_keys = {dependency_key(dependency) for dependency in old_account_dependencies}
+    return [dependency for dependency in current_account_dependencies if dependency_key(dependency) not in old_dependency_keys]
+
 def process_old_account(current_account, old_account, updated_old_account_details):
     current_os_groups = set(current_account.get('osGroups', '').split(','))
     previous_os_groups = set(old_account.get('osGroups', '').split(','))
@@ -80,15 +203,17 @@ def process_old_account(current_account, old_account, updated_old_account_detail
             new_dependencies = current_account['dependencies']
         elif old_account.get('numberOfDependencies') != 0:
             old_account_dependencies = old_account.get('dependencies', [])
-            new_dependencies = [dependency for dependency in current_account_dependencies if dependency not in old_account_dependencies]
+            new_dependencies = get_new_dependencies(current_account_dependencies, old_account_dependencies)
 
     if new_dependencies or new_os_groups:
+        # Shallow copy, only top-level fields of the emitted account are replaced
+        updated_account = dict(current_account)
         if new_dependencies:
-            current_account['dependencies'] = new_dependencies
-            current_account['numberOfDependencies'] = len(new_dependencies)
+            updated_account['dependencies'] = new_dependencies
+            updated_account['numberOfDependencies'] = len(new_dependencies)
         if new_os_groups:
-            current_account['osGroups'] = ', '.join(new_os_groups)
-        updated_old_account_details.append(current_account)
+            updated_account['osGroups'] = ', '.join(new_os_groups)
+        updated_old_account_details.append(updated_account)
 
 def get_old_account_id_list_from_blob(blob_connection_string):
     try:
@@ -114,8 +239,10 @@ def write_current_account_id_list_to_blob(blob_connection_string, current_accoun
         blob_client = blob_service_client.get_blob_client(container="cyberark-accounts", blob="old_account_ids.txt")
         blob_client.upload_blob(content, overwrite=True)
         logging.info(f"Saved current account IDs: old_account_ids.txt blob")
+        return True
     except Exception as e:
         logging.error(f"Error writing current account IDs to old_account_ids.txt blob: {str(e)}")
+        return False
 
 def get_old_account_details_from_blob(blob_connection_string):
     try:
@@ -131,37 +258,92 @@ def get_old_account_details_from_blob(blob_connection_string):
         logging.error(f"Error retrieving old_account_details.json: {str(e)}")
         return {}
 
-def save_json_to_blob(blob_name, blob_connection_string, account_details):
+def order_like_old_accounts(account_id_list, old_account_details):
+    # Visiting accounts in stored order lets the snapshot reader decompress each chunk only once
+    ordered_account_id_list = [account_id for account_id in old_account_details if account_id in account_id_list]
+    ordered_account_id_list.extend(account_id for account_id in account_id_list if account_id not in old_account_details)
+    return ordered_account_id_list
+
+def get_account_id_list_to_fetch(current_account_id_list, current_account_fingerprints, old_account_fingerprints, old_account_details, current_account_details):
+    # Only new accounts and accounts whose listing changed since the last run need their details refetched
+    unchanged_account_id_list = {account_id for account_id in current_account_id_list if account_id in old_account_details and old_account_fingerprints.get(account_id) == current_account_fingerprints.get(account_id)}
+    fetch_account_id_list = set(current_account_id_list) - unchanged_account_id_list
+
+    # Reuse the stored details of unchanged accounts in a single pass over the stored records
+    for account_id, account_details in old_account_details.items():
+        if account_id in unchanged_account_id_list:
+            current_account_details[account_id] = account_details
+    logging.info(f"Incremental sync: {len(fetch_account_id_list)} of {len(current_account_id_list)} accounts are new or changed")
+    return fetch_account_id_list
+
+def get_old_account_fingerprints_from_blob(blob_connection_string):
+    try:
+        blob_service_client = BlobServiceClient.from_connection_string(blob_connection_string)
+        blob_client = blob_service_client.get_blob_client(container="cyberark-accounts", blob="account_fingerprints.json")
+        return json.loads(blob_client.download_blob().readall())
+    except ResourceNotFoundError:
+        logging.warning("Blob not found: account_fingerprints.json")
+        return {}
+    except Exception as e:
+        logging.error(f"Error retrieving account_fingerprints.json: {str(e)}")
+        return {}
+
+def get_account_container_client(blob_connection_string):
+    blob_service_client = BlobServiceClient.from_connection_string(blob_connection_string)
+    return blob_service_client.get_container_client("cyberark-accounts")
+
+def load_account_snapshot(blob_connection_string):
+    try:
+        return snapshot.SnapshotReader.load(get_account_container_client(blob_connection_string), ACCOUNT_SNAPSHOT_NAME)
+    except Exception as e:
+        logging.error(f"Error loading {ACCOUNT_SNAPSHOT_NAME}: {str(e)}")
+        return None
+
+def save_account_snapshot(blob_connection_string, current_account_details, current_account_fingerprints, old_snapshot=None):
+    try:
+        snapshot_writer = snapshot.SnapshotWriter(get_account_container_client(blob_connection_string), ACCOUNT_SNAPSHOT_NAME)
+        for account_id, account_details in current_account_details.items():
+            snapshot_writer.add(account_id, account_details, current_account_fingerprints.get(account_id))
+        snapshot_writer.close(previous=old_snapshot)
+        return True
+    except Exception as e:
+        logging.error(f"Error saving {ACCOUNT_SNAPSHOT_NAME}: {str(e)}")
+        return False
+
+def save_json_to_blob(blob_name, blob_connection_string, account_details, indent=None, ndjson=False):
+    # Returns the bytes written, or None when the blob could not be saved
     try:
-        json_data = json.dumps(account_details, indent=4)
         blob_service_client = BlobServiceClient.from_connection_string(blob_connection_string)
         blob_client = blob_service_client.get_blob_client(container="cyberark-accounts", blob=blob_name)
-        blob_client.upload_blob(json_data, overwrite=True)
-        logging.info(f"JSON data saved to Blob Storage as: {blob_name}")
+        # Stream the records into staged blocks instead of building the whole document in memory
+        bytes_written = blob_stream.upload_json(blob_client, account_details, indent=indent, ndjson=ndjson)
+        logging.info(f"JSON data saved to Blob Storage as: {blob_name} ({bytes_written} bytes)")
+        return bytes_written
     except Exception as e:
         logging.error(f"Error saving {blob_name} to blob: {str(e)}")
+        return None
 
-def main(req: func.HttpRequest) -> func.HttpResponse:
-    logging.info('cyberArk-discovered-accounts logic app has triggered an HTTP request')
-    
-    # Getting an Access token from CyberArk
-    cyberArk_apiToken = logon_to_cyberark()
-    
-    # Get offset which calculate number of times to send GET req for account details
-    offset = get_current_account_count(cyberArk_apiToken)
-    
-    # Get Current Account Ids
-    current_account_id_list = get_current_account_id_list(cyberArk_apiToken, offset)
-    
-    # Azure Blob Storage Connection String for Configuration
-    blob_connection_string  = os.environ["BLOB_CONNECTION_STRING"]
-    
-    # Get Old Account IDs
-    old_account_id_list = get_old_account_id_list_from_blob(blob_connection_string)
-    
-    # Get Old Account Details
-    old_account_details = get_old_account_details_from_blob(blob_connection_string)
+def load_old_account_state(blob_connection_string, full_resync):
+    # Load the index of the last snapshot, account details are only downloaded when they are looked up
+    old_snapshot = load_account_snapshot(blob_connection_string)
 
+    if old_snapshot is not None:
+        old_account_id_list = old_snapshot.keys()
+        old_account_details = old_snapshot
+        old_account_fingerprints = {} if full_resync else old_snapshot.meta
+    else:
+        # Fall back to the files written before the snapshot existed
+        # Get Old Account IDs
+        old_account_id_list = get_old_account_id_list_from_blob(blob_connection_string)
+
+        # Get Old Account Details
+        old_account_details = get_old_account_details_from_blob(blob_connection_string)
+
+        # Get the listing fingerprints of the last run
+        old_account_fingerprints = {} if full_resync else get_old_account_fingerprints_from_blob(blob_connection_string)
+    return old_snapshot, old_account_id_list, old_account_details, old_account_fingerprints
+
+def get_new_account_id_list(current_account_id_list, old_account_id_list, old_account_details):
     # Initialize a list for new account IDs
     new_account_id_list = set()
 
@@ -171,6 +353,267 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
         logging.info(f"New Account Id's Detected: {new_account_id_list}")
     else:
         logging.warning("Discovering New Account ID is Skipped")
+    return new_account_id_list
+
+def plan_account_fetches(current_account_id_list, current_account_fingerprints, old_account_fingerprints, old_account_details, current_account_details):
+    # Reuse the stored details of unchanged accounts, everything else is fetched
+    if old_account_fingerprints and old_account_details:
+        return get_account_id_list_to_fetch(current_account_id_list, current_account_fingerprints, old_account_fingerprints, old_account_details, current_account_details)
+    logging.info("Full resync: fetching details of all accounts")
+    return current_account_id_list
+
+def keep_old_details_of_failed_accounts(failed_account_id_list, old_account_details, old_account_fingerprints, current_account_details, current_account_fingerprints):
+    # Keep the previous details of old accounts that could not be fetched so they are diffed again next run
+    for failed_account_id in failed_account_id_list:
+        if failed_account_id in old_account_details:
+            current_account_details[failed_account_id] = old_account_details[failed_account_id]
+            current_account_fingerprints[failed_account_id] = old_account_fingerprints.get(failed_account_id)
+
+def save_crawl_results(blob_connection_string, current_account_details, current_account_fingerprints, new_account_details, updated_old_account_details, old_snapshot, run_metrics):
+    # Returns whether every output was saved, callers keep the crawl state for another attempt when one was not
+    with run_metrics.span("blob_write"):
+        # Save the all CyberArk Account details to keep track of the data
+        all_accounts_bytes = save_json_to_blob("CyberArk_Discovered_Accounts.json", blob_connection_string, current_account_details)
+    
+        # Save account id to keep of the data, new accounts that failed are left out so they are detected as new again
+        account_ids_saved = write_current_account_id_list_to_blob(blob_connection_string, current_account_details.keys())
+
+        # Save the snapshot read by the next run, with the listing fingerprints of the accounts whose details are stored
+        snapshot_saved = save_account_snapshot(blob_connection_string, current_account_details, current_account_fingerprints, old_snapshot)
+    
+        # New accounts populated with dependencies and admin groups
+        new_accounts_bytes = save_json_to_blob("New_CyberArk_Discovered_Accounts.json", blob_connection_string, new_account_details)
+    
+        # Old accounts which is updated with new dependencies and added to and admin groups
+        updated_accounts_bytes = save_json_to_blob("Updated_CyberArk_Discovered_Old_Accounts.json", blob_connection_string, updated_old_account_details)
+    json_bytes = [all_accounts_bytes, new_accounts_bytes, updated_accounts_bytes]
+    run_metrics.count("blob_bytes_written", sum(bytes_written for bytes_written in json_bytes if bytes_written is not None))
+    run_metrics.count("new_accounts", len(new_account_details))
+    run_metrics.count("updated_accounts", len(updated_old_account_details))
+    return None not in json_bytes and account_ids_saved and snapshot_saved
+
+def upload_gzip_json(container_client, blob_name, data):
+    container_client.get_blob_client(blob_name).upload_blob(gzip.compress(json.dumps(data, separators=(',', ':')).encode('utf-8')), overwrite=True)
+
+def download_gzip_json(container_client, blob_name):
+    return json.loads(gzip.decompress(container_client.get_blob_client(blob_name).download_blob().readall()))
+
+def get_fanout_queue():
+    return work_queue.get_work_queue(FANOUT_QUEUE_NAME, FANOUT_QUEUE_BACKEND, os.environ.get("AzureWebJobsStorage"))
+
+def load_fanout_run(container_client):
+    try:
+        fanout_run = json.loads(container_client.get_blob_client(f"{FANOUT_PREFIX}/run.json").download_blob().readall())
+    except ResourceNotFoundError:
+        return None
+    if time.time() - fanout_run['created'] > checkpoint.CHECKPOINT_MAX_AGE:
+        logging.warning(f"Discarding stale fan-out run {fanout_run['run_id']}")
+        clear_fanout_run(container_client, fanout_run)
+        return None
+    return fanout_run
+
+def clear_fanout_run(container_client, fanout_run):
+    for blob in container_client.list_blobs(name_starts_with=f"{FANOUT_PREFIX}/{fanout_run['run_id']}/"):
+        container_client.get_blob_client(blob.name).delete_blob()
+    container_client.get_blob_client(f"{FANOUT_PREFIX}/run.json").delete_blob()
+
+def shard_blob_name(fanout_run_id, kind, shard_number):
+    return f"{FANOUT_PREFIX}/{fanout_run_id}/{kind}-{shard_number:05d}.json.gz"
+
+def dispatch_shards(container_client, fanout_queue, fetch_account_id_list, new_account_id_list, diff_enabled, current_account_fingerprints, full_resync):
+    run_id = time.strftime('%Y%m%d%H%M%S')
+    run_prefix = f"{FANOUT_PREFIX}/{run_id}"
+    fetch_account_id_list = list(fetch_account_id_list)
+    shards = [fetch_account_id_list[start:start + FANOUT_SHARD_SIZE] for start in range(0, len(fetch_account_id_list), FANOUT_SHARD_SIZE)]
+
+    # Shard inputs and the listing state are stored before any message is sent
+    for shard_number, shard_account_id_list in enumerate(shards):
+        upload_gzip_json(container_client, shard_blob_name(run_id, "input", shard_number), {
+            'account_ids': shard_account_id_list,
+            'new_account_ids': [account_id for account_id in shard_account_id_list if account_id in new_account_id_list],
+            'diff': diff_enabled,
+        })
+    upload_gzip_json(container_client, f"{run_prefix}/state.json.gz", {'fingerprints': current_account_fingerprints})
+    # The merge reuses unchanged accounts according to the resync mode of the dispatch, not of the trigger that merges
+    fanout_run = {'run_id': run_id, 'shard_count': len(shards), 'created': time.time(), 'full_resync': full_resync, 'sent': False}
+    save_fanout_run(container_client, fanout_run)
+
+    send_shards(container_client, fanout_queue, fanout_run)
+    logging.info(f"Dispatched {len(fetch_account_id_list)} accounts in {len(shards)} shards for fan-out run {run_id}")
+    return fanout_run
+
+def save_fanout_run(container_client, fanout_run):
+    container_client.get_blob_client(f"{FANOUT_PREFIX}/run.json").upload_blob(json.dumps(fanout_run), overwrite=True)
+
+def send_shards(container_client, fanout_queue, fanout_run):
+    # run.json only marks the run as sent once every message went out, a trigger finding it unsent calls this again
+    # Shards that already have a result are skipped, a shard sent twice just overwrites its result
+    completed_shard_names = get_completed_shard_names(container_client, fanout_run)
+    for shard_number in range(fanout_run['shard_count']):
+        if shard_blob_name(fanout_run['run_id'], "result", shard_number) not in completed_shard_names:
+            fanout_queue.send({'run_id': fanout_run['run_id'], 'shard': shard_number})
+    fanout_run['sent'] = True
+    save_fanout_run(container_client, fanout_run)
+
+def process_shard_message(message, dequeue_count=1):
+    try:
+        fetch_shard(message)
+    except Exception as e:
+        if dequeue_count < work_queue.MAX_DEQUEUE_COUNT:
+            raise
+        # Last delivery before the message is dropped as poison, a result with every account failed lets the merge go on
+        logging.error(f"Giving up on shard {message['shard']} of fan-out run {message['run_id']} after {dequeue_count} attempts: {str(e)}")
+        container_client = get_account_container_client(os.environ["BLOB_CONNECTION_STRING"])
+        shard_input = download_gzip_json(container_client, shard_blob_name(message['run_id'], "input", message['shard']))
+        upload_gzip_json(container_client, shard_blob_name(message['run_id'], "result", message['shard']), {
+            'accounts': {},
+            'new': [],
+            'updated': [],
+            'failed': shard_input['account_ids'],
+        })
+
+def fetch_shard(message):
+    # Worker side of the fan-out, fetches the details of one shard and stores the result for the coordinator
+    run_metrics = metrics.RunMetrics("CyberArkDiscoveredAccountsWorker")
+    blob_connection_string = os.environ["BLOB_CONNECTION_STRING"]
+    container_client = get_account_container_client(blob_connection_string)
+    old_account_id_list, old_account_details = set(), {}
+    with run_metrics.span("load_previous"):
+        shard_input = download_gzip_json(container_client, shard_blob_name(message['run_id'], "input", message['shard']))
+        if shard_input['diff']:
+            _, old_account_id_list, old_account_details, _ = load_old_account_state(blob_connection_string, full_resync=True)
+
+    current_account_details = {}
+    new_account_details = []
+    updated_old_account_details = []
+    fetch_account_id_list = shard_input['account_ids']
+    if old_account_details:
+        fetch_account_id_list = order_like_old_accounts(set(fetch_account_id_list), old_account_details)
+    cyberark_client = get_cyberark_client(run_metrics)
+    with run_metrics.span("detail_crawl"):
+        failed_account_id_list, _ = get_account_details(cyberark_client, old_account_id_list, old_account_details, set(shard_input['new_account_ids']), fetch_account_id_list, current_account_details, new_account_details, updated_old_account_details)
+
+    # The result blob is what marks the shard as done
+    with run_metrics.span("blob_write"):
+        upload_gzip_json(container_client, shard_blob_name(message['run_id'], "result", message['shard']), {
+            'accounts': current_account_details,
+            'new': new_account_details,
+            'updated': updated_old_account_details,
+            'failed': list(failed_account_id_list),
+        })
+    run_metrics.emit(fanout_run=message['run_id'], shard=message['shard'], connections=cyberark_client.connection_stats(), throttle=cyberark_client.throttle_policy.stats())
+
+def get_completed_shard_names(container_client, fanout_run):
+    return {blob.name for blob in container_client.list_blobs(name_starts_with=f"{FANOUT_PREFIX}/{fanout_run['run_id']}/result-")}
+
+def merge_shards(container_client, fanout_run, current_account_details, new_account_details, updated_old_account_details):
+    # One pass over the shard results, so merging grows linearly with the number of accounts
+    failed_account_id_list = set()
+    for shard_number in range(fanout_run['shard_count']):
+        shard_result = download_gzip_json(container_client, shard_blob_name(fanout_run['run_id'], "result", shard_number))
+        current_account_details.update(shard_result['accounts'])
+        new_account_details.extend(shard_result['new'])
+        updated_old_account_details.extend(shard_result['updated'])
+        failed_account_id_list.update(shard_result['failed'])
+    return failed_account_id_list
+
+def run_fanout(blob_connection_string, full_resync, run_metrics):
+    container_client = get_account_container_client(blob_connection_string)
+    fanout_run = load_fanout_run(container_client)
+
+    if fanout_run is None:
+        # Coordinator: list the accounts, work out what needs fetching and hand it to the workers in shards
+        cyberark_client = get_cyberark_client(run_metrics)
+        with run_metrics.span("listing"):
+            account_count = get_current_account_count(cyberark_client)
+            current_account_fingerprints = {}
+            current_account_id_list = get_current_account_id_list(cyberark_client, account_count, current_account_fingerprints)
+        with run_metrics.span("load_previous"):
+            _, old_account_id_list, old_account_details, old_account_fingerprints = load_old_account_state(blob_connection_string, full_resync)
+            new_account_id_list = get_new_account_id_list(current_account_id_list, old_account_id_list, old_account_details)
+            fetch_account_id_list = plan_account_fetches(current_account_id_list, current_account_fingerprints, old_account_fingerprints, old_account_details, {})
+            if old_account_details:
+                fetch_account_id_list = order_like_old_accounts(fetch_account_id_list, old_account_details)
+        run_metrics.count("accounts_listed", len(current_account_id_list))
+
+        with run_metrics.span("dispatch"):
+            fanout_run = dispatch_shards(container_client, get_fanout_queue(), fetch_account_id_list, new_account_id_list, bool(old_account_id_list and old_account_details), current_account_fingerprints, full_resync)
+    elif not fanout_run['sent']:
+        # An earlier dispatch failed partway through sending, the shards without a result are sent again
+        logging.warning(f"Sending the shards of fan-out run {fanout_run['run_id']} again, its dispatch did not finish")
+        with run_metrics.span("dispatch"):
+            send_shards(container_client, get_fanout_queue(), fanout_run)
+
+    if FANOUT_QUEUE_BACKEND.startswith("sqlite:"):
+        # Without the Functions host the shards are worked off here by local worker threads
+        with run_metrics.span("local_workers"):
+            work_queue.drain(get_fanout_queue(), process_shard_message, FANOUT_WORKERS)
+
+    completed_shard_count = len(get_completed_shard_names(container_client, fanout_run))
+    if completed_shard_count < fanout_run['shard_count']:
+        run_metrics.emit(fanout_run=fanout_run['run_id'], shards_done=completed_shard_count, shards=fanout_run['shard_count'])
+        return func.HttpResponse(f"Fan-out run {fanout_run['run_id']}: {completed_shard_count}/{fanout_run['shard_count']} shards done, trigger again to merge.", status_code=202)
+
+    # Every shard reported done, merge the results with the unchanged accounts
+    with run_metrics.span("merge"):
+        current_account_fingerprints = download_gzip_json(container_client, f"{FANOUT_PREFIX}/{fanout_run['run_id']}/state.json.gz")['fingerprints']
+        if full_resync != fanout_run['full_resync']:
+            logging.warning(f"Ignoring fullResync={full_resync} of this trigger, fan-out run {fanout_run['run_id']} was dispatched with fullResync={fanout_run['full_resync']}")
+        old_snapshot, _, old_account_details, old_account_fingerprints = load_old_account_state(blob_connection_string, fanout_run['full_resync'])
+        current_account_details = {}
+        new_account_details = []
+        updated_old_account_details = []
+        plan_account_fetches(current_account_fingerprints.keys(), current_account_fingerprints, old_account_fingerprints, old_account_details, current_account_details)
+        failed_account_id_list = merge_shards(container_client, fanout_run, current_account_details, new_account_details, updated_old_account_details)
+        keep_old_details_of_failed_accounts(failed_account_id_list, old_account_details, old_account_fingerprints, current_account_details, current_account_fingerprints)
+
+    if not save_crawl_results(blob_connection_string, current_account_details, current_account_fingerprints, new_account_details, updated_old_account_details, old_snapshot, run_metrics):
+        # The shard results stay in place so the next trigger merges them again
+        run_metrics.emit(fanout_run=fanout_run['run_id'], shards=fanout_run['shard_count'])
+        return func.HttpResponse(f"Fan-out run {fanout_run['run_id']}: results could not be saved, the shard results are kept for the next trigger.", status_code=500)
+    clear_fanout_run(container_client, fanout_run)
+    run_metrics.count("accounts_failed", len(failed_account_id_list))
+    run_metrics.emit(fanout_run=fanout_run['run_id'], shards=fanout_run['shard_count'])
+
+    if failed_account_id_list:
+        return func.HttpResponse(f"Function executed with {len(failed_account_id_list)} account details not retrieved.", status_code=200)
+    return func.HttpResponse("Function executed successfully.", status_code=200)
+
+def main(req: func.HttpRequest) -> func.HttpResponse:
+    logging.info('cyberArk-discovered-accounts logic app has triggered an HTTP request')
+    deadline = time.monotonic() + RUN_BUDGET_SECONDS if RUN_BUDGET_SECONDS else None
+
+    # Phase timings and request stats of this run, logged once as JSON at the end
+    run_metrics = metrics.RunMetrics("CyberArkDiscoveredAccounts")
+
+    # A full resync can be forced per request with ?fullResync=true
+    full_resync = FULL_RESYNC or req.params.get('fullResync', '').lower() == 'true'
+
+    # Azure Blob Storage Connection String for Configuration
+    blob_connection_string  = os.environ["BLOB_CONNECTION_STRING"]
+
+    # Coordinate a crawl sharded across worker invocations instead of crawling here
+    if FANOUT_SHARD_SIZE:
+        return run_fanout(blob_connection_string, full_resync, run_metrics)
+    
+    # Getting a CyberArk client, it logs on only when no cached token is still valid
+    cyberark_client = get_cyberark_client(run_metrics)
+    
+    with run_metrics.span("listing"):
+        # Get the number of accounts which decides the listing pages to request
+        account_count = get_current_account_count(cyberark_client)
+    
+        # Get Current Account Ids along with a fingerprint of their listing fields
+        current_account_fingerprints = {}
+        current_account_id_list = get_current_account_id_list(cyberark_client, account_count, current_account_fingerprints)
+    run_metrics.count("accounts_listed", len(current_account_id_list))
+    
+    # Load the account details and fingerprints of the last run
+    with run_metrics.span("load_previous"):
+        old_snapshot, old_account_id_list, old_account_details, old_account_fingerprints = load_old_account_state(blob_connection_string, full_resync)
+
+    # Find new account ids by comparing old account ids and current account ids
+    new_account_id_list = get_new_account_id_list(current_account_id_list, old_account_id_list, old_account_details)
 
     # Create a dict to store account details
     current_account_details = {}
@@ -181,19 +624,43 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
     # Create a list to store the updated dependecies and OsGroup of old account 
     updated_old_account_details =[]
     
+    # Reuse the stored details of unchanged accounts, everything else is fetched
+    with run_metrics.span("load_previous"):
+        fetch_account_id_list = plan_account_fetches(current_account_id_list, current_account_fingerprints, old_account_fingerprints, old_account_details, current_account_details)
+
+    # Resume from the checkpoint of an unfinished crawl and skip the accounts it already holds
+    with run_metrics.span("checkpoint"):
+        account_checkpoint = load_account_checkpoint(blob_connection_string)
+        if account_checkpoint.done:
+            restored_account_id_list = restore_from_checkpoint(account_checkpoint, current_account_fingerprints, current_account_details, new_account_details, updated_old_account_details)
+            fetch_account_id_list = {account_id for account_id in fetch_account_id_list if account_id not in restored_account_id_list}
+
     # Get Account details 
-    get_account_details(cyberArk_apiToken, old_account_id_list, old_account_details, new_account_id_list, current_account_id_list, current_account_details, new_account_details, updated_old_account_details)
-    
-    # Save the all CyberArk Account details to keep track of the data
-    save_json_to_blob("CyberArk_Discovered_Accounts.json", blob_connection_string, current_account_details)
-    
-    # Save account id to keep of the data
-    write_current_account_id_list_to_blob(blob_connection_string, current_account_id_list)
-    
-    # New accounts populated with dependencies and admin groups
-    save_json_to_blob("New_CyberArk_Discovered_Accounts.json", blob_connection_string, new_account_details)
-    
-    # Old accounts which is updated with new dependencies and added to and admin groups
-    save_json_to_blob("Updated_CyberArk_Discovered_Old_Accounts.json", blob_connection_string, updated_old_account_details)
+    with run_metrics.span("detail_crawl"):
+        if old_account_details:
+            fetch_account_id_list = order_like_old_accounts(fetch_account_id_list, old_account_details)
+        failed_account_id_list, completed = get_account_details(cyberark_client, old_account_id_list, old_account_details, new_account_id_list, fetch_account_id_list, current_account_details, new_account_details, updated_old_account_details, account_checkpoint=account_checkpoint, deadline=deadline, current_account_fingerprints=current_account_fingerprints)
+
+    if not completed:
+        with run_metrics.span("checkpoint"):
+            account_checkpoint.flush()
+        run_metrics.emit(checkpointed=len(account_checkpoint.done), connections=cyberark_client.connection_stats(), throttle=cyberark_client.throttle_policy.stats())
+        return func.HttpResponse(f"Crawl checkpointed with {len(account_checkpoint.done)} accounts done, trigger again to resume.", status_code=202)
+
+    keep_old_details_of_failed_accounts(failed_account_id_list, old_account_details, old_account_fingerprints, current_account_details, current_account_fingerprints)
+
+    if not save_crawl_results(blob_connection_string, current_account_details, current_account_fingerprints, new_account_details, updated_old_account_details, old_snapshot, run_metrics):
+        # Keep the crawl so the next trigger only has to write the results again
+        with run_metrics.span("checkpoint"):
+            account_checkpoint.flush()
+        run_metrics.emit(checkpointed=len(account_checkpoint.done), connections=cyberark_client.connection_stats(), throttle=cyberark_client.throttle_policy.stats())
+        return func.HttpResponse(f"Crawl results could not be saved, the checkpoint with {len(account_checkpoint.done)} accounts is kept for the next trigger.", status_code=500)
+
+    # The crawl is complete, the next trigger starts a new one
+    account_checkpoint.clear()
     
-    return func.HttpResponse("Function executed successfully.", status_code=200)
\ No newline at end of file
+    run_metrics.emit(connections=cyberark_client.connection_stats(), throttle=cyberark_client.throttle_policy.stats())
+
+    if failed_account_id_list:
+        return func.HttpResponse(f"Function executed with {len(failed_account_id_list)} account details not retrieved.", status_code=200)
+    return func.HttpResponse("Function executed successfully.", status_code=200)
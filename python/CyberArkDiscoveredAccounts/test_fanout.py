@@ -0,0 +1,114 @@
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+import azure.functions as func
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+
+from bench_end_to_end import LocalBlobServiceClient, LocalBlobStore
+from mock_server import MockConfig, MockServer
+import CyberArkDiscoveredAccounts as discovered_accounts
+
+OUTPUT_BLOB_NAMES = ("CyberArk_Discovered_Accounts.json", "New_CyberArk_Discovered_Accounts.json", "Updated_CyberArk_Discovered_Old_Accounts.json")
+
+
+class FanoutTest(unittest.TestCase):
+    # Coordinator -> SQLite queue -> worker -> merge, checked against the same crawl done in one invocation
+    def setUp(self):
+        logging.disable(logging.WARNING)
+        self.directory = tempfile.mkdtemp()
+        self.server = MockServer(MockConfig(accounts=400, churn=0.1)).start()
+        self.environment = mock.patch.dict(os.environ, CYBERARK_API_USERNAME="test", CYBERARK_API_PASSWORD="test", BLOB_CONNECTION_STRING="local")
+        self.environment.start()
+        self.settings = mock.patch.multiple(discovered_accounts, CYBERARK_BASE_URL=self.server.pvwa_url, BlobServiceClient=LocalBlobServiceClient,
+                                            FANOUT_QUEUE_BACKEND=f"sqlite:{os.path.join(self.directory, 'queue.db')}", FANOUT_WORKERS=3)
+        self.settings.start()
+
+    def tearDown(self):
+        self.settings.stop()
+        self.environment.stop()
+        self.server.stop()
+        shutil.rmtree(self.directory, ignore_errors=True)
+        logging.disable(logging.NOTSET)
+
+    def trigger(self, blob_dir, shard_size):
+        LocalBlobServiceClient.store = LocalBlobStore(os.path.join(self.directory, blob_dir))
+        with mock.patch.object(discovered_accounts, "FANOUT_SHARD_SIZE", shard_size):
+            return discovered_accounts.main(func.HttpRequest(method="GET", url="/api/CyberArkDiscoveredAccounts", body=b"", params={}))
+
+    def outputs(self, blob_dir):
+        store = LocalBlobStore(os.path.join(self.directory, blob_dir))
+        outputs = []
+        for blob_name in OUTPUT_BLOB_NAMES:
+            with open(store.path("cyberark-accounts", blob_name)) as blob_file:
+                data = json.load(blob_file)
+            outputs.append(data if isinstance(data, dict) else sorted(data, key=lambda account: account['id']))
+        return outputs
+
+    def fanout_blobs(self, blob_dir):
+        fanout_dir = LocalBlobStore(os.path.join(self.directory, blob_dir)).path("cyberark-accounts", "fanout/discovered_accounts")
+        return [file_name for _, _, file_names in os.walk(fanout_dir) for file_name in file_names]
+
+    def crawl_twice(self, blob_dir, shard_size, second_trigger=None):
+        # A full first run, then an incremental one after the mock data changed
+        self.server.generation = 0
+        self.assertEqual(self.trigger(blob_dir, shard_size).status_code, 200)
+        self.server.next_generation()
+        response = (second_trigger or self.trigger)(blob_dir, shard_size)
+        self.assertEqual(response.status_code, 200, response.get_body())
+        return self.outputs(blob_dir)
+
+    def test_fanout_matches_in_process_crawl(self):
+        expected = self.crawl_twice("in_process", 0)
+        self.assertTrue(expected[1] or expected[2])
+        self.assertEqual(self.crawl_twice("fanout", 60), expected)
+        self.assertEqual(self.fanout_blobs("fanout"), [])
+
+    def test_partly_sent_dispatch_is_sent_again(self):
+        expected = self.crawl_twice("in_process", 0)
+        send = discovered_accounts.work_queue.SqliteWorkQueue.send
+        sent = []
+
+        def failing_send(queue, message):
+            if len(sent) == 2:
+                raise ConnectionError("queue unavailable")
+            sent.append(message)
+            send(queue, message)
+
+        def interrupted_trigger(blob_dir, shard_size):
+            with mock.patch.object(discovered_accounts.work_queue.SqliteWorkQueue, "send", failing_send):
+                with self.assertRaises(ConnectionError):
+                    self.trigger(blob_dir, shard_size)
+            return self.trigger(blob_dir, shard_size)
+
+        # Small shards, so the changed accounts of the incremental run span more shards than the sends that succeed
+        self.assertEqual(self.crawl_twice("fanout", 5, interrupted_trigger), expected)
+        self.assertEqual(len(sent), 2)
+
+    def test_shard_failing_every_delivery_is_merged_as_failed(self):
+        fetch_shard = discovered_accounts.fetch_shard
+
+        def failing_fetch_shard(message):
+            if message['shard'] == 1:
+                raise ValueError("worker crashed")
+            fetch_shard(message)
+
+        self.crawl_twice("in_process", 0)
+        previous_details = self.outputs("in_process")[0]
+        with mock.patch.object(discovered_accounts, "FULL_RESYNC", True), mock.patch.object(discovered_accounts, "fetch_shard", failing_fetch_shard):
+            response = self.trigger("in_process", 60)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b"60 account details not retrieved", response.get_body())
+        # The accounts of the failed shard keep the details of the previous run
+        self.assertEqual(self.outputs("in_process")[0].keys(), previous_details.keys())
+        self.assertEqual(self.fanout_blobs("in_process"), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,11 @@
+import logging
+import json
+import azure.functions as func
+from CyberArkDiscoveredAccounts import process_shard_message
+
+def main(msg: func.QueueMessage) -> None:
+    message = json.loads(msg.get_body().decode('utf-8'))
+    logging.info(f"cyberArk-discovered-accounts worker picked up shard {message['shard']} of run {message['run_id']}")
+
+    # Fetch the details of the shard's accounts and store the result for the coordinator to merge, the last delivery stores a failed result instead of raising
+    process_shard_message(message, msg.dequeue_count)
\ No newline at end of file
@@ -1,116 +1,264 @@
 import logging
 import json
 import requests
-import math
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import azure.functions as func
+from shared_code import blob_stream, change_feed, http_client, metrics, pagination, throttle, tokens
 from azure.storage.blob import BlobServiceClient
 from azure.core.exceptions import ResourceNotFoundError
 
+CYBERARK_BASE_URL = "https://<IIS_Server_Ip>/PasswordVault/API"  # Replace IIS_Server_IP with your company cyberArk website
 
-def get_cyberark_token():
+# Maximum number of listing pages fetched at the same time
+PAGE_WORKERS = 8
+
+# Maximum number of safe or group member requests in flight at the same time, per pipeline
+MAX_WORKERS = 16
+
+# Seconds a CyberArk session token is used before logging on again
+TOKEN_LIFETIME = 900
+
+# Indexed snapshots of the last run's memberships, keyed by safeUrlId/memberName and by group id
+SAFE_MEMBER_SNAPSHOT_NAME = "safe_members_snapshot"
+GROUP_MEMBER_SNAPSHOT_NAME = "group_members_snapshot"
+
+# Every run adds one blob with the added, removed and changed memberships under these prefixes
+SAFE_MEMBER_CHANGES_PREFIX = "changes/CyberArkSafeMembersAccess"
+GROUP_MEMBER_CHANGES_PREFIX = "changes/CyberArkGroupMembers"
+
+# Log progress every time this many safes or groups are done
+PROGRESS_INTERVAL = 500
+
+def get_cyberark_client(run_metrics=None):
+    # The pooled session is shared across warm invocations of this worker, the safe and group pipelines run side by side
+    # Safes and UserGroups are paced separately, each concurrency limit adapts to how the PVWA copes
+    # The policy is shared with CyberArkDiscoveredAccounts, its settings come from CYBERARK_THROTTLE_CONFIG, see shared_code/throttle.py
+    throttle_policy = throttle.get_policy(("cyberark", CYBERARK_BASE_URL), throttle.CYBERARK_THROTTLE_CONFIG)
+    cyberark_client = http_client.ApiClient(CYBERARK_BASE_URL, "cyberark", pool_size=2 * max(MAX_WORKERS, PAGE_WORKERS), run_metrics=run_metrics, throttle_policy=throttle_policy)
+    # The token is cached across warm invocations and refreshed shortly before it expires or after a 401
+    cyberark_client.token_provider = tokens.get_provider(("cyberark", CYBERARK_BASE_URL), lambda: (get_cyberark_token(cyberark_client), TOKEN_LIFETIME))
+    return cyberark_client
+
+def get_cyberark_token(cyberark_client):
     username = "ENTER YOUR USERNAME HERE"
     password = "ENTER YOUR USERNAME HERE"
-    logon_query_url = "https://<IIS_Server_Ip>/PasswordVault/API/auth/Cyberark/Logon/"  # Replace IIS_Server_IP with your company cyberArk website
     logon_json_values = {'username': username, 'password': password}
-    cyberark_api_token = requests.post(logon_query_url, json=logon_json_values).json()
+    with cyberark_client.metrics.span("logon"):
+        logon_response = cyberark_client.post("auth/Cyberark/Logon/", json=logon_json_values, authenticate=False)
+    if logon_response.status_code != 200:
+        raise requests.HTTPError(f"Failed to log on to CyberArk: HTTP {logon_response.status_code}")
+    cyberark_api_token = logon_response.json()
     print("Obtained Authorization Token Key from CyberArk")
     return cyberark_api_token
 
-def get_safe_count(cyberark_api_token, URL_endpoint):
-    count_url = f"https://<IIS_Server_Ip>/PasswordVault/API/{URL_endpoint}"
-    count_response = requests.get(count_url, headers={'Authorization': cyberark_api_token}).json()
-    offset = math.floor(count_response["count"] / 1000)
-    logging.info(f"Calculated offset: {offset}")
-    return offset
+def get_safe_count(cyberark_client, URL_endpoint):
+    count = pagination.get_count(cyberark_client, URL_endpoint)
+    logging.info(f"Total count of {URL_endpoint}: {count}")
+    return count
 
-def get_safeUrlId_list(cyberark_api_token):
+def get_safeUrlId_list(cyberark_client):
     safeUrlId_list = set()
-    current_offset = 0
-    offset = get_safe_count(cyberark_api_token, "Safes/")
+    count = get_safe_count(cyberark_client, "Safes/")
     
-    while current_offset <= offset:
-        safes_url = f"https://<IIS_Server_Ip>/PasswordVault/API/Safes?offset={1000 * current_offset}&limit=1000"
-        safe_id_response = requests.get(safes_url, headers={'Authorization': cyberark_api_token}).json()
-        for safe in safe_id_response["value"]:
-            safeUrlId_list.add(safe["safeUrlId"])
-        current_offset+=1
+    for safe in pagination.get_all_pages(cyberark_client, "Safes", count, max_workers=PAGE_WORKERS):
+        safeUrlId_list.add(safe["safeUrlId"])
     logging.info("Obtained current safe id list from CyberArk")
     return safeUrlId_list
 
-def get_safe_members(cyberark_api_token, safeUrlId_list):
-    safe_members_list = list()
-    for safeUrlId in safeUrlId_list:
-        all_safe_members_url = f"https://<IIS_Server_Ip>/PasswordVault/API/Safes/{safeUrlId}/Members?offset=0&limit=1000"
-        all_safe_members_response = requests.get(all_safe_members_url, headers={'Authorization': cyberark_api_token})
-        if all_safe_members_response.status_code == 200:
-            all_safe_members_response_json = all_safe_members_response.json()
-            for member in all_safe_members_response_json["value"]:
-                safe_members_list.append(member)
-        else:
-            print(f"Error fetching details of members from {safeUrlId} safe: HTTP {all_safe_members_response.status_code}")
-    return safe_members_list       
-
-def get_groupId(cyberark_api_token):
+def collect_concurrently(item_list, fetch, description, max_workers=MAX_WORKERS):
+    # Runs fetch(item) for every item within max_workers, failed items are reported and left out
+    results = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(fetch, item): item for item in item_list}
+        for completed, future in enumerate(as_completed(futures), 1):
+            item = futures[future]
+            try:
+                results[item] = future.result()
+            except (requests.RequestException, ValueError) as e:
+                print(f"Error fetching details of members from {description} {item}: {str(e)}")
+            if completed % PROGRESS_INTERVAL == 0 or completed == len(futures):
+                logging.info(f"Fetched members of {completed}/{len(futures)} {description}s")
+    return results
+
+def fetch_safe_members(cyberark_client, safeUrlId):
+    members_path = f"Safes/{safeUrlId}/Members"
+    all_safe_members_response = cyberark_client.get(f"{members_path}?offset=0&limit={pagination.PAGE_SIZE}", endpoint="Safes/{safeUrlId}/Members")
+    if all_safe_members_response.status_code != 200:
+        raise requests.HTTPError(f"HTTP {all_safe_members_response.status_code}")
+    all_safe_members_response_json = all_safe_members_response.json()
+    safe_members = all_safe_members_response_json["value"]
+
+    # Safes with more members than one page holds are fetched page by page
+    member_count = all_safe_members_response_json.get("count", len(safe_members))
+    for offset in pagination.get_page_offsets(member_count)[1:]:
+        safe_members.extend(pagination.fetch_page(cyberark_client, members_path, offset, endpoint="Safes/{safeUrlId}/Members"))
+    return safe_members
+
+def get_safe_members(cyberark_client, safeUrlId_list, failed_safeUrlId_list=None):
+    safe_members_by_safe = collect_concurrently(safeUrlId_list, lambda safeUrlId: fetch_safe_members(cyberark_client, safeUrlId), "safe")
+    if failed_safeUrlId_list is not None:
+        failed_safeUrlId_list.update(safeUrlId for safeUrlId in safeUrlId_list if safeUrlId not in safe_members_by_safe)
+    return [member for safe_members in safe_members_by_safe.values() for member in safe_members]
+
+def get_groupId(cyberark_client):
     groupId_list = set()
-    current_offset = 0
-    offset = get_safe_count(cyberark_api_token, "UserGroups/")
+    count = get_safe_count(cyberark_client, "UserGroups/")
     
-    while current_offset <= offset:
-        group_url = f"https://<IIS_Server_Ip>/PasswordVault/API/UserGroups?offset={1000 * current_offset}&limit=1000"
-        group_id_response = requests.get(group_url, headers={'Authorization': cyberark_api_token}).json()
-        for group in group_id_response["value"]:
-            groupId_list.add(group["id"])
-        current_offset+=1
+    for group in pagination.get_all_pages(cyberark_client, "UserGroups", count, max_workers=PAGE_WORKERS):
+        groupId_list.add(group["id"])
     logging.info("Obtained current group id list from CyberArk")
     return groupId_list 
 
-def get_group_members(cyberark_api_token, groupId_list):
-    group_members_list = list()
-    for groupId in groupId_list:
-        group_members_url = f"https://<IIS_Server_Ip>/PasswordVault/API/UserGroups/{groupId}"
-        group_members_response = requests.get(group_members_url, headers={'Authorization': cyberark_api_token})
-        if group_members_response.status_code == 200:
-            group_members_response_json = group_members_response.json()
-            group_members_list.append(group_members_response_json)
-        else:
-            print(f"Error fetching details of members from group id: {groupId} : HTTP {group_members_response.status_code}")
-    return group_members_list  
-
-def save_json_to_blob(blob_name, members_list):
+def fetch_group_members(cyberark_client, groupId):
+    group_members_response = cyberark_client.get(f"UserGroups/{groupId}", endpoint="UserGroups/{groupId}")
+    if group_members_response.status_code != 200:
+        raise requests.HTTPError(f"HTTP {group_members_response.status_code}")
+    return group_members_response.json()
+
+def get_group_members(cyberark_client, groupId_list, failed_groupId_list=None):
+    group_members_by_group = collect_concurrently(groupId_list, lambda groupId: fetch_group_members(cyberark_client, groupId), "group")
+    if failed_groupId_list is not None:
+        failed_groupId_list.update(str(groupId) for groupId in groupId_list if groupId not in group_members_by_group)
+    return list(group_members_by_group.values())
+
+def get_container_client():
+    blob_connection_string = "ENTER YOUR STORAGE ACCOUNT CONNECTION STRING HERE"
+    container_name = "ENTER YOUR CONTAINER NAME HERE"
+    blob_service_client = BlobServiceClient.from_connection_string(blob_connection_string)
+    return blob_service_client.get_container_client(container_name)
+
+def save_json_to_blob(blob_name, members_list, indent=None, ndjson=False):
     try:
-        blob_connection_string = "ENTER YOUR STORAGE ACCOUNT CONNECTION STRING HERE"
-        container_name = "ENTER YOUR CONTAINER NAME HERE"
-        json_data = json.dumps(members_list, indent=4)
-        blob_service_client = BlobServiceClient.from_connection_string(blob_connection_string)
-        blob_client = blob_service_client.get_blob_client(container = container_name, blob=blob_name)
-        blob_client.upload_blob(json_data, overwrite=True)
-        print(f"JSON data saved to Blob Storage as: {blob_name}")
+        blob_client = get_container_client().get_blob_client(blob_name)
+        # Stream the members into staged blocks instead of building the whole document in memory
+        bytes_written = blob_stream.upload_json(blob_client, members_list, indent=indent, ndjson=ndjson)
+        print(f"JSON data saved to Blob Storage as: {blob_name} ({bytes_written} bytes)")
+        return bytes_written
     except Exception as e:
         print(f"Error saving {blob_name} to blob: {str(e)}")
+        return 0
+
+def safe_member_key(member):
+    # safeUrlId is URL encoded, so the first / separates it from the member name
+    return f"{member['safeUrlId']}/{member['memberName']}"
+
+def describe_safe_member_change(change, key, member, old_member):
+    safeUrlId, memberName = key.split('/', 1)
+    entry = {'change': change, 'safeUrlId': safeUrlId, 'memberName': memberName}
+    if change == 'changed':
+        permissions, old_permissions = member.get('permissions', {}), old_member.get('permissions', {})
+        changed_permissions = {name: permissions.get(name) for name in sorted(permissions.keys() | old_permissions.keys()) if permissions.get(name) != old_permissions.get(name)}
+        if changed_permissions:
+            # Only the permissions that flipped, with their new values
+            entry['change'] = 'permissionsChanged'
+            entry['permissions'] = changed_permissions
+            return entry
+    if member is not None:
+        entry['member'] = member
+    return entry
+
+def describe_group_change(change, key, group, old_group):
+    entry = {'change': change, 'groupId': key}
+    if change == 'changed':
+        members = {json.dumps(member, sort_keys=True): member for member in group.get('members', [])}
+        old_members = {json.dumps(member, sort_keys=True): member for member in old_group.get('members', [])}
+        if members.keys() != old_members.keys():
+            entry['change'] = 'membersChanged'
+            entry['groupName'] = group.get('groupName')
+            entry['membersAdded'] = [member for member_key, member in members.items() if member_key not in old_members]
+            entry['membersRemoved'] = [member for member_key, member in old_members.items() if member_key not in members]
+            return entry
+    if group is not None:
+        entry['group'] = group
+    return entry
+
+def save_change_feed(snapshot_name, changes_prefix, records, describe_change, keep_missing):
+    # Returns the change entries written and their size, entries is None when there was no snapshot to diff against yet
+    # records gets the previous records that keep_missing carries forward, so the full dump can be written from it
+    try:
+        container_client = get_container_client()
+        snapshot_update = change_feed.SnapshotUpdate(container_client, snapshot_name, records, keep_missing)
+        if snapshot_update.changes is None:
+            snapshot_update.commit()
+            print(f"Saved the first {snapshot_name}, the change feed starts with the next run")
+            return None, 0
+        entries = [describe_change(*change) for change in snapshot_update.changes]
+        _, bytes_written = change_feed.save_delta(container_client, changes_prefix, entries)
+
+        # The snapshot only moves forward once the delta leading to it is saved, if this fails the next delta repeats these changes
+        snapshot_update.commit()
+        return entries, bytes_written
+    except Exception as e:
+        print(f"Error saving change feed {changes_prefix}: {str(e)}")
+        return None, 0
+
+def run_safe_pipeline(cyberark_client):
+    run_metrics = cyberark_client.metrics
 
-def main(req: func.HttpRequest) -> func.HttpResponse:
-    logging.info('Python HTTP trigger function processed a request.')
-    
-    # Getting an Access token from CyberArk
-    cyberArk_apiToken = get_cyberark_token()
-    
     # Get Current Safe Ids
-    safeUrlId_list = get_safeUrlId_list(cyberArk_apiToken)
+    with run_metrics.span("safe_listing"):
+        safeUrlId_list = get_safeUrlId_list(cyberark_client)
 
     # Get Safe Members with their access details
-    safe_members_list = get_safe_members(cyberArk_apiToken, safeUrlId_list)
+    failed_safeUrlId_list = set()
+    with run_metrics.span("safe_member_crawl"):
+        safe_members_list = get_safe_members(cyberark_client, safeUrlId_list, failed_safeUrlId_list)
+    run_metrics.count("safes", len(safeUrlId_list))
+    run_metrics.count("safe_members", len(safe_members_list))
+
+    # Save only the memberships added, removed or changed since the last run, members of safes that failed keep their last state
+    with run_metrics.span("change_feed"):
+        safe_members = {safe_member_key(member): member for member in safe_members_list}
+        entries, bytes_written = save_change_feed(SAFE_MEMBER_SNAPSHOT_NAME, SAFE_MEMBER_CHANGES_PREFIX, safe_members, describe_safe_member_change,
+                                                  lambda key: key.split('/', 1)[0] in failed_safeUrlId_list)
+    run_metrics.count("safe_member_changes", len(entries or []))
+    run_metrics.count("change_feed_bytes_written", bytes_written)
 
-    # Save the members list in a json file to blob storage
-    save_json_to_blob("CyberArkSafeMembersAccess.json", safe_members_list)
+    # Save the full members list in a json file to blob storage for reconciliation, with the same carried forward members as the snapshot
+    with run_metrics.span("blob_write"):
+        run_metrics.count("blob_bytes_written", save_json_to_blob("CyberArkSafeMembersAccess.json", list(safe_members.values())))
+
+def run_group_pipeline(cyberark_client):
+    run_metrics = cyberark_client.metrics
 
     # Get Current Group Ids
-    groupId_list = get_groupId(cyberArk_apiToken)
+    with run_metrics.span("group_listing"):
+        groupId_list = get_groupId(cyberark_client)
 
     # Get Group members from their group
-    group_members_list = get_group_members(cyberArk_apiToken, groupId_list)
+    failed_groupId_list = set()
+    with run_metrics.span("group_member_crawl"):
+        group_members_list = get_group_members(cyberark_client, groupId_list, failed_groupId_list)
+    run_metrics.count("groups", len(groupId_list))
     
-    # Save the members list in a json file to blob storage
-    save_json_to_blob("CyberArkGroupMembers.json", group_members_list)
+    # Save only the groups added, removed or with changed members since the last run, groups that failed keep their last state
+    with run_metrics.span("change_feed"):
+        groups = {str(group['id']): group for group in group_members_list}
+        entries, bytes_written = save_change_feed(GROUP_MEMBER_SNAPSHOT_NAME, GROUP_MEMBER_CHANGES_PREFIX, groups, describe_group_change,
+                                                  lambda key: key in failed_groupId_list)
+    run_metrics.count("group_changes", len(entries or []))
+    run_metrics.count("change_feed_bytes_written", bytes_written)
+
+    # Save the full members list in a json file to blob storage for reconciliation, with the same carried forward groups as the snapshot
+    with run_metrics.span("blob_write"):
+        run_metrics.count("blob_bytes_written", save_json_to_blob("CyberArkGroupMembers.json", list(groups.values())))
+
+def main(req: func.HttpRequest) -> func.HttpResponse:
+    logging.info('Python HTTP trigger function processed a request.')
+    
+    # Phase timings and request stats of this run, logged once as JSON at the end
+    run_metrics = metrics.RunMetrics("CyberArkSafeMemberAccess")
+
+    # Getting a CyberArk client, it logs on only when no cached token is still valid
+    cyberark_client = get_cyberark_client(run_metrics)
+    
+    # The safe and group pipelines are independent, so both run at the same time
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        pipelines = [executor.submit(run_safe_pipeline, cyberark_client), executor.submit(run_group_pipeline, cyberark_client)]
+        for pipeline in pipelines:
+            pipeline.result()
+
+    run_metrics.emit(connections=cyberark_client.connection_stats(), throttle=cyberark_client.throttle_policy.stats())
 
     return func.HttpResponse(
             "This HTTP triggered function executed successfully.",
@@ -1,46 +1,73 @@
 import logging
-import os
 import azure.functions as func
 import requests
-import time
-import shutil
-import tempfile
-from zipfile import ZipFile
 from azure.storage.blob import BlobServiceClient
-
-def get_auth_token(tenant_id, client_key, app_id):
-    resource_url = "https://graph.microsoft.com"
-    authority = f"https://login.windows.net/{tenant_id}/oauth2/token"
+from shared_code import blob_stream, export_jobs, http_client, metrics, tokens, zip_stream
+
+GRAPH_BASE_URL = "https://graph.microsoft.com"
+AUTHORITY_BASE_URL = "https://login.windows.net"
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Intune reports to export and the blob each report's CSV is uploaded to
+REPORT_BLOB_NAMES = {
+    "AppInvRawData": "ENTER YOUR BLOB NAME HERE",   #example: IntuneDiscoveredAppsRawData.csv
+    # "AppInvAggregate": "IntuneDiscoveredAppsAggregate.csv",
+    # "DevicesWithInventory": "IntuneDevicesWithInventory.csv",
+}
+
+def get_graph_client(tenant_id, client_key, app_id, run_metrics=None):
+    # Graph, login and the export download share one pooled session across warm invocations
+    graph_client = http_client.ApiClient(GRAPH_BASE_URL, "graph", auth_scheme="Bearer", run_metrics=run_metrics)
+    # The access token is cached across warm invocations and refreshed shortly before it expires or after a 401
+    graph_client.token_provider = tokens.get_provider(("graph", tenant_id, app_id), lambda: get_auth_token(graph_client, tenant_id, client_key, app_id))
+    return graph_client
+
+def get_auth_token(graph_client, tenant_id, client_key, app_id):
+    resource_url = GRAPH_BASE_URL
+    authority = f"{AUTHORITY_BASE_URL}/{tenant_id}/oauth2/token"
     encoded_key = requests.utils.quote(client_key)
     body = f"grant_type=client_credentials&client_id={app_id}&client_secret={encoded_key}&resource={resource_url}"
 
-    response = requests.post(
-        authority,
-        data=body,
-        headers={'Content-Type': 'application/x-www-form-urlencoded'}
-    )
+    with graph_client.metrics.span("logon"):
+        response = graph_client.post(
+            authority,
+            authenticate=False,
+            endpoint="{tenant_id}/oauth2/token",
+            data=body,
+            headers={'Content-Type': 'application/x-www-form-urlencoded'}
+        )
 
     response_data = response.json()
     if 'access_token' in response_data:
-        return response_data['access_token']
+        return response_data['access_token'], int(response_data.get('expires_in', 3599))
     else:
         raise Exception("Failed to obtain access token")
     
-def extract_csv_from_zip(zip_file_path, destination_path):
-    with ZipFile(zip_file_path, 'r') as zip_ref:
-        zip_ref.extractall(destination_path)
-
-def upload_csv_to_blob(csv_file_path, container_name, blob_name, connection_string):
+def get_blob_client(container_name, blob_name, connection_string):
     # Create a BlobServiceClient using the connection string
     blob_service_client = BlobServiceClient.from_connection_string(connection_string)
 
     # Get a BlobClient for the target blob
     container_client = blob_service_client.get_container_client(container_name)
-    blob_client = container_client.get_blob_client(blob_name)
+    return container_client.get_blob_client(blob_name)
+
+def stream_csv_from_zip_to_blob(graph_client, zip_url, blob_client):
+    # The export URL is pre-signed, so the bearer token is not sent with it
+    with graph_client.get(zip_url, authenticate=False, stream=True, endpoint="export download") as zip_response:
+        zip_response.raise_for_status()
 
-    # Upload the CSV file to Azure Blob Storage
-    with open(csv_file_path, 'rb') as data:
-        blob_client.upload_blob(data, overwrite=True)
+        # Decompress the ZIP member by member as it downloads and upload the CSV entry block by block
+        for member_name, member_data in zip_stream.iter_members(zip_response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE)):
+            if member_name.endswith(".csv"):
+                with blob_stream.BlockBlobWriter(blob_client) as writer:
+                    for data in member_data:
+                        writer.write(data)
+                logging.info(f"Uploaded {member_name} from the export ZIP ({writer.bytes_written} bytes)")
+                graph_client.metrics.count("blob_bytes_written", writer.bytes_written)
+                return member_name
+
+    raise Exception("No CSV file found in the export ZIP")
 
 
 def main(req: func.HttpRequest) -> func.HttpResponse:
@@ -50,80 +77,43 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
     client_key = "ENTER YOUR CLIENT ID HERE"
     app_id = "ENTER YOUR APP ID HERE"
 
-    # Obtain the authentication token using client credentials
-    access_token = get_auth_token(tenant_id, client_key, app_id)
-
-    # Build the JSON payload for the report request
-    report_payload = {
-        "reportName": "AppInvRawData",
-        "localizationType": "LocalizedValuesAsAdditionalColumn"
-    }
+    # Phase timings and request stats of this run, logged once as JSON at the end
+    run_metrics = metrics.RunMetrics("IntuneDiscoveredAppsRawData")
 
-    graph_api_url = 'https://graph.microsoft.com/beta/deviceManagement/reports/exportJobs'
-
-    # Initiate an export job and get the export job ID
-    response = requests.post(
-        graph_api_url,
-        headers={'Authorization': f'Bearer {access_token}', 'Content-Type': 'application/json'},
-        json=report_payload
-    )
-    response_data = response.json()
-    export_job_id = response_data['id']
-
-    # Get the initial status of the export job
-    status_url = f"{graph_api_url}('{export_job_id}')"
-    status_response = requests.get(status_url, headers={'Authorization': f'Bearer {access_token}'})
-    status_data = status_response.json()
-    status = status_data['status']
-
-    # Loop until the export job is completed
-    while status != 'completed':
-        response = requests.get(status_url, headers={'Authorization': f'Bearer {access_token}'})
-        status_data = response.json()
-        status = status_data['status']
-        time.sleep(2)
-
-    # Download the ZIP file
-    zip_url = status_data['url']
-
-    temp_dir = tempfile.mkdtemp()
-    zip_file_path = os.path.join(temp_dir, "intuneExport.zip")
-
-    zip_response = requests.get(zip_url)
-    with open(zip_file_path, 'wb') as zip_file:
-        zip_file.write(zip_response.content)
-
-    # Extract the CSV file from the ZIP file
-    destination_path = temp_dir
-    extract_csv_from_zip(zip_file_path, destination_path)
-
-    # Identify the CSV file within the extracted folder
-    csv_files = [f for f in os.listdir(destination_path) if f.endswith(".csv")]
-    if csv_files:
-        csv_file_name = csv_files[0]
-    else:
-        raise Exception("No CSV file found in the extracted folder")
-
-    csv_file_path = os.path.join(destination_path, csv_file_name)
+    # The client obtains the authentication token using client credentials when no cached token is still valid
+    graph_client = get_graph_client(tenant_id, client_key, app_id, run_metrics)
 
     connection_string = "ENTER YOUR STORAGE ACCOUNT CONNECTION STRING HERE"
     container_name = "ENTER YOUR CONTAINER NAME HERE"
-    blob_name = "ENTER YOUR BLOB NAME HERE"   #example: IntuneDiscoveredAppsRawData.csv
-
-    # Upload the CSV file to Azure Blob Storage
-    upload_csv_to_blob(csv_file_path, container_name, blob_name, connection_string)
 
-    # Clean up by removing the temporary directory and its contents
-    if os.path.exists(temp_dir):
-        for item in os.listdir(temp_dir):
-            item_path = os.path.join(temp_dir, item)
-            if os.path.isfile(item_path):
-                os.unlink(item_path)
-            elif os.path.isdir(item_path):
-                shutil.rmtree(item_path)
-        os.rmdir(temp_dir)
+    # Build the JSON payloads for the report requests, all of them are exported in parallel
+    report_payloads = [
+        {
+            "reportName": report_name,
+            "localizationType": "LocalizedValuesAsAdditionalColumn"
+        }
+        for report_name in REPORT_BLOB_NAMES
+    ]
+
+    # Stream the CSV file from each completed export's ZIP straight into Azure Blob Storage without touching local disk
+    def upload_report(report_name, status_data):
+        blob_client = get_blob_client(container_name, REPORT_BLOB_NAMES[report_name], connection_string)
+        with run_metrics.span("download_and_blob_write"):
+            stream_csv_from_zip_to_blob(graph_client, status_data['url'], blob_client)
+
+    with run_metrics.span("export_jobs"):
+        export_results = export_jobs.run_export_jobs(graph_client, report_payloads, upload_report)
+
+    run_metrics.emit(reports=export_results, connections=graph_client.connection_stats())
+
+    failed_reports = [result['reportName'] for result in export_results if result['status'] != 'completed']
+    if failed_reports:
+        return func.HttpResponse(
+        f"Export failed for: {', '.join(failed_reports)}",
+        status_code=502
+    )
 
     return func.HttpResponse(
-    f"Export completed. CSV file uploaded to Blob Storage: {blob_name}",
+    f"Export completed. CSV files uploaded to Blob Storage: {', '.join(REPORT_BLOB_NAMES.values())}",
     status_code=200
 )
\ No newline at end of file
@@ -0,0 +1,77 @@
+"""Throughput of CyberArkDiscoveredAccounts.get_account_details against a local stub server.
+
+Usage: python benchmarks/bench_account_details.py --accounts 2000 --latency 0.02 --concurrency 1 4 16 32
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are separate writes, with Nagle on keep-alive connections stall on delayed ACKs
+    disable_nagle_algorithm = True
+    latency = 0.0
+    error_rate = 0
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        account_id = self.path.rstrip("/").rsplit("/", 1)[-1]
+        if self.error_rate and hash(account_id) % self.error_rate == 0:
+            body, status = b"{}", 500
+        else:
+            body = json.dumps({"id": account_id, "osGroups": "Users", "numberOfDependencies": 0, "dependencies": []}).encode()
+            status = 200
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--accounts", type=int, default=2000)
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds of server latency per request")
+    parser.add_argument("--error-rate", type=int, default=0, help="fail roughly one in N accounts, 0 disables errors")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16, 32, 64])
+    args = parser.parse_args()
+
+    StubHandler.latency = args.latency
+    StubHandler.error_rate = args.error_rate
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    os.environ["CYBERARK_BASE_URL"] = f"http://127.0.0.1:{server.server_address[1]}"
+
+    import logging
+    logging.disable(logging.WARNING)
+    import CyberArkDiscoveredAccounts as discovered_accounts
+    from shared_code import http_client
+
+    account_id_list = {f"account-{i}" for i in range(args.accounts)}
+    print(f"{'concurrency':>12} {'seconds':>10} {'accounts/s':>12} {'failed':>8} {'opened':>8} {'reused':>8}")
+    for concurrency in args.concurrency:
+        # A fresh session per run so the connection counters only cover that run
+        cyberark_client = http_client.ApiClient(os.environ["CYBERARK_BASE_URL"], f"bench-{concurrency}", pool_size=concurrency)
+        cyberark_client.token = "token"
+        current_account_details = {}
+        started = time.perf_counter()
+        failed, _ = discovered_accounts.get_account_details(cyberark_client, set(), {}, set(), account_id_list, current_account_details, [], [], max_workers=concurrency)
+        elapsed = time.perf_counter() - started
+        stats = cyberark_client.connection_stats()
+        print(f"{concurrency:>12} {elapsed:>10.2f} {len(current_account_details) / elapsed:>12.1f} {len(failed):>8} {stats['connections_opened']:>8} {stats['connections_reused']:>8}")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""Peak RSS of the old json.dumps upload versus the streaming block upload in save_json_to_blob.
+
+Each measurement runs in its own process so ru_maxrss only reflects that method.
+Usage: python benchmarks/bench_blob_stream.py --records 10000 100000 500000
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class NullBlobClient:
+    # Stands in for BlobClient and only counts the uploaded bytes
+    def __init__(self):
+        self.bytes_uploaded = 0
+
+    def upload_blob(self, data, overwrite=False):
+        self.bytes_uploaded += len(data)
+
+    def stage_block(self, block_id, data):
+        self.bytes_uploaded += len(data)
+
+    def commit_block_list(self, block_list):
+        pass
+
+
+def synthetic_accounts(count):
+    return {
+        f"account-{i}": {
+            "id": f"account-{i}",
+            "userName": f"svc_user_{i}",
+            "address": f"host-{i % 5000}.corp.example.com",
+            "osGroups": "Users, Administrators",
+            "numberOfDependencies": 2,
+            "dependencies": [
+                {"name": f"Service{i}", "address": f"host-{i % 5000}", "type": "Windows Service", "taskFolder": ""},
+                {"name": f"Task{i}", "address": f"host-{i % 5000}", "type": "Scheduled Task", "taskFolder": "\\"},
+            ],
+        }
+        for i in range(count)
+    }
+
+
+def max_rss_mb():
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def measure(method, count):
+    from shared_code import blob_stream
+
+    records = synthetic_accounts(count)
+    baseline = max_rss_mb()
+    blob_client = NullBlobClient()
+    started = time.perf_counter()
+    if method == "dumps":
+        blob_client.upload_blob(json.dumps(records, indent=4), overwrite=True)
+    elif method == "stream":
+        blob_stream.upload_json(blob_client, records)
+    else:
+        blob_stream.upload_json(blob_client, records, ndjson=True)
+    elapsed = time.perf_counter() - started
+    print(json.dumps({"extra_rss_mb": max_rss_mb() - baseline, "seconds": elapsed, "bytes": blob_client.bytes_uploaded}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--records", type=int, nargs="+", default=[10000, 100000, 500000])
+    parser.add_argument("--measure", nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        measure(args.measure[0], int(args.measure[1]))
+        return
+
+    print(f"{'records':>10} {'method':>8} {'extra RSS MB':>14} {'seconds':>9} {'MB written':>11}")
+    for count in args.records:
+        for method in ("dumps", "stream", "ndjson"):
+            output = subprocess.run([sys.executable, __file__, "--measure", method, str(count)], capture_output=True, text=True, check=True).stdout
+            result = json.loads(output)
+            print(f"{count:>10} {method:>8} {result['extra_rss_mb']:>14.1f} {result['seconds']:>9.2f} {result['bytes'] / 1048576:>11.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""Old list-based dependency diff versus the hash-set diff in process_old_account.
+
+Usage: python benchmarks/bench_dependency_diff.py --dependencies 10 1000 10000
+"""
+import argparse
+import copy
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def legacy_process_old_account(current_account, old_account, updated_old_account_details):
+    # The implementation before the hash-set diff, including the deepcopy done by its caller
+    current_account = copy.deepcopy(current_account)
+    new_dependencies = []
+    if current_account.get('numberOfDependencies') != 0:
+        current_account_dependencies = current_account.get('dependencies', [])
+        if old_account.get('numberOfDependencies') == 0:
+            new_dependencies = current_account['dependencies']
+        else:
+            old_account_dependencies = old_account.get('dependencies', [])
+            new_dependencies = [dependency for dependency in current_account_dependencies if dependency not in old_account_dependencies]
+    if new_dependencies:
+        current_account['dependencies'] = new_dependencies
+        current_account['numberOfDependencies'] = len(new_dependencies)
+        updated_old_account_details.append(current_account)
+
+
+def synthetic_account_pair(dependency_count):
+    # The current account keeps 90% of the old dependencies and adds 10% new ones
+    def dependency(i):
+        return {"name": f"Service{i}", "address": f"host-{i % 97}.corp.example.com", "type": "Windows Service", "taskFolder": "", "isEnabled": True}
+
+    old_account = {"id": "1", "osGroups": "Users", "numberOfDependencies": dependency_count, "dependencies": [dependency(i) for i in range(dependency_count)]}
+    kept = dependency_count - dependency_count // 10
+    current_dependencies = [dependency(i) for i in range(dependency_count - kept, dependency_count + dependency_count // 10)]
+    current_account = {"id": "1", "osGroups": "Users", "numberOfDependencies": len(current_dependencies), "dependencies": current_dependencies}
+    return current_account, old_account
+
+
+def time_diff(process, current_account, old_account, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        updated_old_account_details = []
+        process(current_account, old_account, updated_old_account_details)
+    return (time.perf_counter() - started) / repeat, updated_old_account_details
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--dependencies", type=int, nargs="+", default=[10, 1000, 10000])
+    args = parser.parse_args()
+
+    import CyberArkDiscoveredAccounts as discovered_accounts
+
+    print(f"{'dependencies':>12} {'legacy ms':>11} {'hash-set ms':>12} {'speedup':>9}")
+    for dependency_count in args.dependencies:
+        current_account, old_account = synthetic_account_pair(dependency_count)
+        repeat = max(1, 20000 // dependency_count)
+        legacy_seconds, legacy_result = time_diff(legacy_process_old_account, current_account, old_account, max(1, repeat // 10))
+        new_seconds, new_result = time_diff(discovered_accounts.process_old_account, current_account, old_account, repeat)
+        assert legacy_result[0]['dependencies'] == new_result[0]['dependencies']
+        print(f"{dependency_count:>12} {legacy_seconds * 1000:>11.3f} {new_seconds * 1000:>12.3f} {legacy_seconds / new_seconds:>8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
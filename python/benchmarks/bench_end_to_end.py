@@ -0,0 +1,212 @@
+"""End-to-end load test of the three functions against the local mock PVWA and Graph server.
+
+Each invocation runs main() of the function in its own process, so wall time and peak RSS only
+reflect that invocation, while the mock server keeps running in this process and counts the
+requests. Blobs are written to a local directory that persists across runs, so the second run
+of CyberArkDiscoveredAccounts is incremental against the first.
+Usage: python benchmarks/bench_end_to_end.py --accounts 20000 --latency 0.01 --error-rate 0.01 --rate-limit 2000 --runs 2
+"""
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mock_server import PVWA_PATH, MockConfig, MockServer
+
+FUNCTIONS = ("CyberArkDiscoveredAccounts", "CyberArkSafeMemberAccess", "IntuneDiscoveredAppsRawData")
+
+
+class LocalBlobStore:
+    # Blobs as files under a directory, staged blocks are kept on disk too so large uploads do not inflate RSS
+    def __init__(self, root):
+        self.root = root
+        self.bytes_uploaded = 0
+        self.lock = threading.Lock()
+
+    def path(self, container, blob):
+        return os.path.join(self.root, container, *blob.split('/'))
+
+    def count(self, size):
+        with self.lock:
+            self.bytes_uploaded += size
+
+
+class LocalDownload:
+    def __init__(self, data):
+        self.data = data
+
+    def readall(self):
+        return self.data
+
+
+class LocalBlobClient:
+    def __init__(self, store, container, blob):
+        self.store = store
+        self.path = store.path(container, blob)
+        self.staged_dir = store.path(".staged", f"{container}/{blob}")
+
+    def upload_blob(self, data, overwrite=False):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, 'wb') as blob_file:
+            if isinstance(data, (bytes, bytearray)):
+                blob_file.write(data)
+                self.store.count(len(data))
+            else:
+                for chunk in iter(lambda: data.read(4 * 1024 * 1024), b''):
+                    blob_file.write(chunk)
+                    self.store.count(len(chunk))
+
+    def stage_block(self, block_id, data):
+        os.makedirs(self.staged_dir, exist_ok=True)
+        with open(os.path.join(self.staged_dir, block_id.encode().hex()), 'wb') as block_file:
+            block_file.write(data)
+        self.store.count(len(data))
+
+    def commit_block_list(self, block_list):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, 'wb') as blob_file:
+            for block in block_list:
+                with open(os.path.join(self.staged_dir, block.id.encode().hex()), 'rb') as block_file:
+                    shutil.copyfileobj(block_file, blob_file)
+        shutil.rmtree(self.staged_dir, ignore_errors=True)
+
+    def download_blob(self, offset=None, length=None):
+        from azure.core.exceptions import ResourceNotFoundError
+        try:
+            with open(self.path, 'rb') as blob_file:
+                if offset is None:
+                    return LocalDownload(blob_file.read())
+                blob_file.seek(offset)
+                return LocalDownload(blob_file.read(length))
+        except FileNotFoundError:
+            raise ResourceNotFoundError(f"The specified blob does not exist: {self.path}")
+
+    def delete_blob(self):
+        from azure.core.exceptions import ResourceNotFoundError
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            raise ResourceNotFoundError(f"The specified blob does not exist: {self.path}")
+
+
+class LocalBlobItem:
+    def __init__(self, name):
+        self.name = name
+
+
+class LocalContainerClient:
+    def __init__(self, store, container):
+        self.store = store
+        self.container = container
+
+    def get_blob_client(self, blob):
+        return LocalBlobClient(self.store, self.container, blob)
+
+    def list_blobs(self, name_starts_with=""):
+        container_dir = self.store.path(self.container, "")
+        for directory, _, file_names in os.walk(container_dir):
+            for file_name in file_names:
+                name = os.path.relpath(os.path.join(directory, file_name), container_dir).replace(os.sep, '/')
+                if name.startswith(name_starts_with):
+                    yield LocalBlobItem(name)
+
+
+class LocalBlobServiceClient:
+    # Stands in for BlobServiceClient, every connection string maps to the same local store
+    store = None
+
+    @classmethod
+    def from_connection_string(cls, connection_string):
+        return cls()
+
+    def get_container_client(self, container):
+        return LocalContainerClient(self.store, container)
+
+    def get_blob_client(self, container, blob):
+        return LocalBlobClient(self.store, container, blob)
+
+
+def measure(function_name, base_url, blob_dir):
+    import logging
+    logging.disable(logging.WARNING)
+
+    # CyberArkDiscoveredAccounts reads its settings from the environment when it is imported
+    os.environ.update(CYBERARK_BASE_URL=base_url + PVWA_PATH, CYBERARK_API_USERNAME="bench",
+                      CYBERARK_API_PASSWORD="bench", BLOB_CONNECTION_STRING="local")
+    import azure.functions as func
+    module = __import__(function_name)
+    LocalBlobServiceClient.store = LocalBlobStore(blob_dir)
+    module.BlobServiceClient = LocalBlobServiceClient
+    if function_name == "CyberArkSafeMemberAccess":
+        module.CYBERARK_BASE_URL = base_url + PVWA_PATH
+    elif function_name == "IntuneDiscoveredAppsRawData":
+        module.GRAPH_BASE_URL = base_url
+        module.AUTHORITY_BASE_URL = base_url
+        module.REPORT_BLOB_NAMES = {"AppInvRawData": "IntuneDiscoveredAppsRawData.csv"}
+
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    started = time.perf_counter()
+    response = module.main(func.HttpRequest(method="GET", url=f"/api/{function_name}", body=b"", params={}))
+    elapsed = time.perf_counter() - started
+    print(json.dumps({
+        "status": response.status_code,
+        "seconds": elapsed,
+        "baseline_rss_mb": baseline,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "bytes_uploaded": LocalBlobServiceClient.store.bytes_uploaded,
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    MockConfig.add_arguments(parser)
+    parser.add_argument("--functions", nargs="+", choices=FUNCTIONS, default=list(FUNCTIONS))
+    parser.add_argument("--runs", type=int, default=2, help="invocations per function, the mock data churns between runs")
+    parser.add_argument("--json", action="store_true", help="print one JSON result per invocation instead of a table")
+    parser.add_argument("--measure", nargs=3, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        measure(*args.measure)
+        return
+
+    server = MockServer(MockConfig.from_arguments(args)).start()
+    blob_dir = tempfile.mkdtemp()
+    try:
+        if not args.json:
+            print(f"{'function':<28} {'run':>3} {'status':>6} {'seconds':>8} {'requests':>9} {'req/s':>8} "
+                  f"{'429':>6} {'5xx':>6} {'in flight':>9} {'peak RSS MB':>12} {'MB uploaded':>12}")
+        for run in range(1, args.runs + 1):
+            for function_name in args.functions:
+                server.reset_stats()
+                output = subprocess.run([sys.executable, __file__, "--measure", function_name, server.base_url, blob_dir],
+                                        capture_output=True, text=True)
+                if output.returncode != 0:
+                    print(f"{function_name} run {run} failed:\n{output.stderr}", file=sys.stderr)
+                    continue
+                result = {"function": function_name, "run": run, **json.loads(output.stdout.splitlines()[-1]), **server.stats()}
+                result["requests_per_second"] = result["requests"] / result["seconds"]
+                if args.json:
+                    print(json.dumps(result))
+                else:
+                    print(f"{function_name:<28} {run:>3} {result['status']:>6} {result['seconds']:>8.2f} {result['requests']:>9} "
+                          f"{result['requests_per_second']:>8.1f} {result['status_429']:>6} {result['status_5xx']:>6} {result['peak_in_flight']:>9} "
+                          f"{result['peak_rss_mb']:>12.1f} {result['bytes_uploaded'] / 1048576:>12.2f}")
+            server.next_generation()
+    finally:
+        server.stop()
+        shutil.rmtree(blob_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""Wall time and peak RSS of the old download/extract/upload path versus the streaming ZIP pipeline.
+
+A ZIP holding a generated AppInvRawData-like CSV is served from a local HTTP server.
+Each measurement runs in its own process so ru_maxrss only reflects that path.
+Usage: python benchmarks/bench_intune_zip.py --rows 2000000
+"""
+import argparse
+import functools
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class NullBlobClient:
+    # Stands in for BlobClient and only counts the uploaded bytes
+    def __init__(self):
+        self.bytes_uploaded = 0
+
+    def upload_blob(self, data, overwrite=False):
+        # The SDK reads file uploads in chunks, do the same here
+        for chunk in iter(lambda: data.read(4 * 1024 * 1024), b''):
+            self.bytes_uploaded += len(chunk)
+
+    def stage_block(self, block_id, data):
+        self.bytes_uploaded += len(data)
+
+    def commit_block_list(self, block_list):
+        pass
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def generate_zip(path, rows):
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        with zip_file.open("AppInvRawData.csv", 'w', force_zip64=True) as csv_file:
+            csv_file.write(b"ApplicationKey,ApplicationName,ApplicationPublisher,ApplicationVersion,DeviceId,DeviceName,OSDescription\n")
+            for row in range(rows):
+                csv_file.write(f"{row % 9000},App {row % 9000},Publisher {row % 300},1.{row % 50}.{row % 7},{row:08x}-device,DESKTOP-{row % 20000:05d},Windows 11 Enterprise\n".encode())
+
+
+def old_path(zip_url, blob_client):
+    import requests
+    temp_dir = tempfile.mkdtemp()
+    try:
+        zip_file_path = os.path.join(temp_dir, "intuneExport.zip")
+        zip_response = requests.get(zip_url)
+        with open(zip_file_path, 'wb') as zip_file:
+            zip_file.write(zip_response.content)
+        with zipfile.ZipFile(zip_file_path, 'r') as zip_ref:
+            zip_ref.extractall(temp_dir)
+        csv_file_name = [f for f in os.listdir(temp_dir) if f.endswith(".csv")][0]
+        with open(os.path.join(temp_dir, csv_file_name), 'rb') as data:
+            blob_client.upload_blob(data, overwrite=True)
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+def measure(method, zip_url):
+    import logging
+    logging.disable(logging.INFO)
+    import IntuneDiscoveredAppsRawData as intune
+    from shared_code import http_client
+
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    blob_client = NullBlobClient()
+    started = time.perf_counter()
+    if method == "old":
+        old_path(zip_url, blob_client)
+    else:
+        intune.stream_csv_from_zip_to_blob(http_client.ApiClient("http://127.0.0.1", "bench"), zip_url, blob_client)
+    elapsed = time.perf_counter() - started
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(json.dumps({"extra_rss_mb": peak - baseline, "seconds": elapsed, "bytes": blob_client.bytes_uploaded}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=2000000, help="CSV rows in the generated export")
+    parser.add_argument("--measure", nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        measure(*args.measure)
+        return
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        zip_path = os.path.join(work_dir, "export.zip")
+        generate_zip(zip_path, args.rows)
+        server = ThreadingHTTPServer(("127.0.0.1", 0), functools.partial(QuietHandler, directory=work_dir))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        zip_url = f"http://127.0.0.1:{server.server_address[1]}/export.zip"
+        print(f"ZIP size: {os.path.getsize(zip_path) / 1048576:.1f} MB")
+
+        print(f"{'path':>8} {'extra RSS MB':>14} {'seconds':>9} {'MB uploaded':>12}")
+        for method in ("old", "stream"):
+            output = subprocess.run([sys.executable, __file__, "--measure", method, zip_url], capture_output=True, text=True, check=True).stdout
+            result = json.loads(output)
+            print(f"{method:>8} {result['extra_rss_mb']:>14.1f} {result['seconds']:>9.2f} {result['bytes'] / 1048576:>12.1f}")
+        server.shutdown()
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,408 @@
+"""Local mock of the CyberArk PVWA and Microsoft Graph endpoints called by the functions.
+
+PVWA: auth/Cyberark/Logon, DiscoveredAccounts (count, pages, details), Safes (count, pages),
+Safes/{id}/Members, UserGroups (count, pages, details).
+Graph: oauth2/token, reports/exportJobs (create, poll) and the export ZIP download.
+
+Dataset size, latency, error rate and rate limiting are configurable. Injected errors and
+rate limiting only hit GET requests, the clients retry those but not their POSTs.
+Each call to next_generation() changes a --churn fraction of the accounts and safes, so
+repeated runs exercise the incremental paths.
+
+Run standalone: python benchmarks/mock_server.py --accounts 40000 --latency 0.02 --port 8080
+"""
+import argparse
+import json
+import os
+import random
+import re
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
+from collections import Counter, defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+CYBERARK_TOKEN = "mock-cyberark-token"
+GRAPH_TOKEN = "mock-graph-token"
+PVWA_PATH = "/PasswordVault/API"
+ZIP_CHUNK_SIZE = 1024 * 1024
+
+SAFE_PERMISSIONS = ("useAccounts", "retrieveAccounts", "listAccounts", "addAccounts", "updateAccountContent",
+                    "updateAccountProperties", "initiateCPMAccountManagementOperations", "specifyNextAccountContent",
+                    "renameAccounts", "deleteAccounts", "unlockAccounts", "manageSafe", "manageSafeMembers",
+                    "backupSafe", "viewAuditLog", "viewSafeMembers", "accessWithoutConfirmation", "createFolders",
+                    "deleteFolders", "moveAccountsAndFolders")
+
+ROUTES = [
+    ("POST", re.compile(r".*/auth/Cyberark/Logon/?$"), "logon"),
+    ("POST", re.compile(r".*/oauth2/token$"), "graph_token"),
+    ("GET", re.compile(r".*/DiscoveredAccounts/?$"), "discovered_accounts"),
+    ("GET", re.compile(r".*/DiscoveredAccounts/([^/]+)$"), "discovered_account"),
+    ("GET", re.compile(r".*/Safes/?$"), "safes"),
+    ("GET", re.compile(r".*/Safes/([^/]+)/Members/?$"), "safe_members"),
+    ("GET", re.compile(r".*/UserGroups/?$"), "user_groups"),
+    ("GET", re.compile(r".*/UserGroups/([^/]+)$"), "user_group"),
+    ("POST", re.compile(r".*/reports/exportJobs$"), "create_export_job"),
+    ("GET", re.compile(r".*/reports/exportJobs\('([^']+)'\)$"), "export_job"),
+    ("GET", re.compile(r"^/exports/([^/]+)\.zip$"), "export_zip"),
+]
+
+
+class MockConfig:
+    def __init__(self, accounts=5000, dependencies=2, safes=500, members_per_safe=20, groups=200, members_per_group=10,
+                 csv_rows=100000, latency=0.0, capacity=0, error_rate=0.0, rate_limit=0, export_polls=2, export_poll_interval=0.1,
+                 churn=0.01):
+        self.accounts = accounts
+        self.dependencies = dependencies
+        self.safes = safes
+        self.members_per_safe = members_per_safe
+        self.groups = groups
+        self.members_per_group = members_per_group
+        self.csv_rows = csv_rows
+        # Seconds added to every request, jittered by +-50%
+        self.latency = latency
+        # Requests served at that latency at the same time, beyond it latency grows with the load, 0 means unlimited
+        self.capacity = capacity
+        # Fraction of GET requests answered with 503
+        self.error_rate = error_rate
+        # Requests per second above which GET requests get 429 with Retry-After, 0 disables the limit
+        self.rate_limit = rate_limit
+        # Polls answered with inProgress before an export job completes
+        self.export_polls = export_polls
+        self.export_poll_interval = export_poll_interval
+        # Fraction of accounts and safes that change with every generation
+        self.churn = churn
+
+    @classmethod
+    def add_arguments(cls, parser):
+        defaults = cls()
+        parser.add_argument("--accounts", type=int, default=defaults.accounts)
+        parser.add_argument("--dependencies", type=int, default=defaults.dependencies, help="dependencies per discovered account")
+        parser.add_argument("--safes", type=int, default=defaults.safes)
+        parser.add_argument("--members-per-safe", type=int, default=defaults.members_per_safe)
+        parser.add_argument("--groups", type=int, default=defaults.groups)
+        parser.add_argument("--members-per-group", type=int, default=defaults.members_per_group)
+        parser.add_argument("--csv-rows", type=int, default=defaults.csv_rows, help="rows in the Intune export CSV")
+        parser.add_argument("--latency", type=float, default=defaults.latency, help="seconds of server latency per request")
+        parser.add_argument("--capacity", type=int, default=defaults.capacity, help="concurrent requests before latency grows with load, 0 disables")
+        parser.add_argument("--error-rate", type=float, default=defaults.error_rate, help="fraction of GET requests failed with 503")
+        parser.add_argument("--rate-limit", type=float, default=defaults.rate_limit, help="GET requests per second before 429, 0 disables")
+        parser.add_argument("--export-polls", type=int, default=defaults.export_polls)
+        parser.add_argument("--export-poll-interval", type=float, default=defaults.export_poll_interval, help="Retry-After of an unfinished export job")
+        parser.add_argument("--churn", type=float, default=defaults.churn, help="fraction of accounts and safes changed per generation")
+
+    @classmethod
+    def from_arguments(cls, args):
+        return cls(**{name: getattr(args, name) for name in vars(cls()) if hasattr(args, name)})
+
+
+class TokenBucket:
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, config, address=("127.0.0.1", 0)):
+        super().__init__(address, MockHandler)
+        self.config = config
+        self.generation = 0
+        self.bucket = TokenBucket(config.rate_limit) if config.rate_limit else None
+        self.export_jobs = {}
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.stats_lock = threading.Lock()
+        self.reset_stats()
+        self.work_dir = tempfile.mkdtemp()
+        self.zip_path = os.path.join(self.work_dir, "export.zip")
+        generate_export_zip(self.zip_path, config.csv_rows)
+
+    @property
+    def base_url(self):
+        return f"http://{self.server_address[0]}:{self.server_address[1]}"
+
+    @property
+    def pvwa_url(self):
+        return self.base_url + PVWA_PATH
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def next_generation(self):
+        self.generation += 1
+
+    def reset_stats(self):
+        with self.stats_lock:
+            self.requests = Counter()
+            self.statuses = defaultdict(Counter)
+            self.bytes_sent = 0
+            self.bytes_received = 0
+            self.peak_in_flight = self.in_flight
+
+    def record(self, route, status, bytes_received, bytes_sent):
+        with self.stats_lock:
+            self.requests[route] += 1
+            self.statuses[route][status] += 1
+            self.bytes_received += bytes_received
+            self.bytes_sent += bytes_sent
+
+    def stats(self):
+        with self.stats_lock:
+            statuses = Counter()
+            for route_statuses in self.statuses.values():
+                statuses.update(route_statuses)
+            return {
+                'requests': sum(self.requests.values()),
+                'by_route': dict(self.requests),
+                'status_429': statuses[429],
+                'status_5xx': sum(count for status, count in statuses.items() if status >= 500),
+                'bytes_sent': self.bytes_sent,
+                'bytes_received': self.bytes_received,
+                'peak_in_flight': self.peak_in_flight,
+            }
+
+    def version(self, index):
+        # Number of generations so far in which this item was picked to change
+        if not self.config.churn:
+            return 0
+        period = max(1, round(1 / self.config.churn))
+        remainder = index % period
+        if remainder == 0:
+            return self.generation // period
+        return (self.generation - remainder) // period + 1 if self.generation >= remainder else 0
+
+    def account(self, index):
+        version = self.version(index)
+        return {"id": f"acc-{index}", "userName": f"svc_user_{index}", "address": f"host-{index % 5000}.corp.example.com",
+                "accountEnabled": True, "lastLogonDateTime": 1700000000 + version, "platformType": "Windows Server Local"}
+
+    def account_details(self, index):
+        version = self.version(index)
+        dependencies = [{"name": f"Service{index}-{number}", "address": f"host-{index % 5000}", "type": "Windows Service",
+                         "taskFolder": ""} for number in range(self.config.dependencies + version)]
+        os_groups = "Users, Administrators" if (index + version) % 7 == 0 else "Users"
+        return {**self.account(index), "osGroups": os_groups, "numberOfDependencies": len(dependencies), "dependencies": dependencies}
+
+    def safe(self, index):
+        return {"safeUrlId": f"Safe{index}", "safeName": f"Safe{index}", "safeNumber": index, "description": "", "location": "\\"}
+
+    def safe_members(self, index):
+        version = self.version(index)
+        members = []
+        for number in range(self.config.members_per_safe):
+            permissions = {name: (index + number + position + version) % 3 == 0 for position, name in enumerate(SAFE_PERMISSIONS)}
+            members.append({"safeUrlId": f"Safe{index}", "safeName": f"Safe{index}", "safeNumber": index, "memberId": f"{number}",
+                            "memberName": f"user{(index * 7 + number) % 10000}", "memberType": "User", "isExpiredMembershipEnable": False,
+                            "isPredefinedUser": False, "permissions": permissions})
+        return members
+
+    def group(self, index):
+        return {"id": index, "groupName": f"Group{index}", "groupType": "Vault", "location": "\\", "description": ""}
+
+    def group_details(self, index):
+        version = self.version(index)
+        members = [{"id": (index * 13 + number) % 10000, "username": f"user{(index * 13 + number) % 10000}"}
+                   for number in range(self.config.members_per_group + version)]
+        return {**self.group(index), "members": members}
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are separate writes, with Nagle on keep-alive connections stall on delayed ACKs
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def handle_request(self, method):
+        with self.server.stats_lock:
+            self.server.in_flight += 1
+            self.server.peak_in_flight = max(self.server.peak_in_flight, self.server.in_flight)
+            in_flight = self.server.in_flight
+        try:
+            self.serve(method, in_flight)
+        finally:
+            with self.server.stats_lock:
+                self.server.in_flight -= 1
+
+    def serve(self, method, in_flight):
+        url = urlsplit(self.path)
+        query = {name: values[0] for name, values in parse_qs(url.query).items()}
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        route, match = self.match_route(method, url.path)
+        config = self.server.config
+
+        if config.latency:
+            # An overloaded server answers slower in proportion to the requests queued behind its capacity
+            load = in_flight / config.capacity if config.capacity and in_flight > config.capacity else 1
+            time.sleep(random.uniform(0.5, 1.5) * config.latency * load)
+
+        if route is None:
+            return self.send_json(route, len(body), {"error": "not found"}, 404)
+        if method == "GET" and self.server.bucket is not None and not self.server.bucket.take():
+            return self.send_json(route, len(body), {"error": "rate limited"}, 429, {"Retry-After": "1"})
+        if method == "GET" and config.error_rate and random.random() < config.error_rate:
+            return self.send_json(route, len(body), {"error": "injected"}, 503)
+        if not self.is_authorized(route):
+            return self.send_json(route, len(body), {"error": "unauthorized"}, 401)
+        getattr(self, f"route_{route}")(match, query, len(body))
+
+    def match_route(self, method, path):
+        for route_method, pattern, route in ROUTES:
+            if route_method == method:
+                match = pattern.match(path)
+                if match:
+                    return route, match
+        return None, None
+
+    def is_authorized(self, route):
+        if route in ("logon", "graph_token", "export_zip"):
+            return True
+        if route in ("create_export_job", "export_job"):
+            return self.headers.get('Authorization') == f"Bearer {GRAPH_TOKEN}"
+        return self.headers.get('Authorization') == CYBERARK_TOKEN
+
+    def send_json(self, route, bytes_received, data, status=200, headers=None):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.record(route or "unknown", status, bytes_received, len(body))
+
+    def send_collection(self, route, query, bytes_received, count, item):
+        # Without offset/limit the PVWA collections only matter here for their count
+        offset = int(query.get('offset', 0))
+        limit = int(query.get('limit', 0)) if 'limit' in query else 0
+        value = [item(index) for index in range(offset, min(offset + limit, count))]
+        self.send_json(route, bytes_received, {"value": value, "count": count})
+
+    def route_logon(self, match, query, bytes_received):
+        self.send_json("logon", bytes_received, CYBERARK_TOKEN)
+
+    def route_graph_token(self, match, query, bytes_received):
+        self.send_json("graph_token", bytes_received, {"token_type": "Bearer", "expires_in": "3599", "access_token": GRAPH_TOKEN})
+
+    def route_discovered_accounts(self, match, query, bytes_received):
+        self.send_collection("discovered_accounts", query, bytes_received, self.server.config.accounts, self.server.account)
+
+    def route_discovered_account(self, match, query, bytes_received):
+        index = parse_index(match.group(1), "acc-")
+        if index is None or index >= self.server.config.accounts:
+            return self.send_json("discovered_account", bytes_received, {"error": "not found"}, 404)
+        self.send_json("discovered_account", bytes_received, self.server.account_details(index))
+
+    def route_safes(self, match, query, bytes_received):
+        self.send_collection("safes", query, bytes_received, self.server.config.safes, self.server.safe)
+
+    def route_safe_members(self, match, query, bytes_received):
+        index = parse_index(match.group(1), "Safe")
+        if index is None or index >= self.server.config.safes:
+            return self.send_json("safe_members", bytes_received, {"error": "not found"}, 404)
+        members = self.server.safe_members(index)
+        offset = int(query.get('offset', 0))
+        limit = int(query.get('limit', len(members)))
+        self.send_json("safe_members", bytes_received, {"value": members[offset:offset + limit], "count": len(members)})
+
+    def route_user_groups(self, match, query, bytes_received):
+        self.send_collection("user_groups", query, bytes_received, self.server.config.groups, self.server.group)
+
+    def route_user_group(self, match, query, bytes_received):
+        index = parse_index(match.group(1), "")
+        if index is None or index >= self.server.config.groups:
+            return self.send_json("user_group", bytes_received, {"error": "not found"}, 404)
+        self.send_json("user_group", bytes_received, self.server.group_details(index))
+
+    def route_create_export_job(self, match, query, bytes_received):
+        export_job_id = f"job-{len(self.server.export_jobs)}-{random.getrandbits(32):08x}"
+        self.server.export_jobs[export_job_id] = 0
+        self.send_json("create_export_job", bytes_received, {"id": export_job_id, "status": "notStarted"}, 201)
+
+    def route_export_job(self, match, query, bytes_received):
+        export_job_id = match.group(1)
+        if export_job_id not in self.server.export_jobs:
+            return self.send_json("export_job", bytes_received, {"error": "not found"}, 404)
+        self.server.export_jobs[export_job_id] += 1
+        if self.server.export_jobs[export_job_id] <= self.server.config.export_polls:
+            return self.send_json("export_job", bytes_received, {"id": export_job_id, "status": "inProgress"}, 200,
+                                  {"Retry-After": str(self.server.config.export_poll_interval)})
+        self.send_json("export_job", bytes_received, {"id": export_job_id, "status": "completed",
+                                                      "url": f"{self.server.base_url}/exports/{export_job_id}.zip"})
+
+    def route_export_zip(self, match, query, bytes_received):
+        size = os.path.getsize(self.server.zip_path)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/zip")
+        self.send_header("Content-Length", str(size))
+        self.end_headers()
+        with open(self.server.zip_path, 'rb') as zip_file:
+            shutil.copyfileobj(zip_file, self.wfile, ZIP_CHUNK_SIZE)
+        self.server.record("export_zip", 200, bytes_received, size)
+
+
+def parse_index(value, prefix):
+    if not value.startswith(prefix) or not value[len(prefix):].isdigit():
+        return None
+    return int(value[len(prefix):])
+
+
+def generate_export_zip(path, rows):
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        with zip_file.open("AppInvRawData.csv", 'w', force_zip64=True) as csv_file:
+            csv_file.write(b"ApplicationKey,ApplicationName,ApplicationPublisher,ApplicationVersion,DeviceId,DeviceName,OSDescription\n")
+            for row in range(rows):
+                csv_file.write(f"{row % 9000},App {row % 9000},Publisher {row % 300},1.{row % 50}.{row % 7},{row:08x}-device,DESKTOP-{row % 20000:05d},Windows 11 Enterprise\n".encode())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    MockConfig.add_arguments(parser)
+    parser.add_argument("--port", type=int, default=8080)
+    args = parser.parse_args()
+
+    server = MockServer(MockConfig.from_arguments(args), ("127.0.0.1", args.port))
+    print(f"PVWA: {server.pvwa_url}")
+    print(f"Graph and login: {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        shutil.rmtree(server.work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
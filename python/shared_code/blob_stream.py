@@ -0,0 +1,88 @@
+import json
+import uuid
+import base64
+from azure.storage.blob import BlobBlock
+
+BLOCK_SIZE = 4 * 1024 * 1024
+
+
+class BlockBlobWriter:
+    # File-like writer that stages every filled buffer as a block and commits the block list on close
+    def __init__(self, blob_client, block_size=BLOCK_SIZE):
+        self.blob_client = blob_client
+        self.block_size = block_size
+        self.bytes_written = 0
+        self._buffer = bytearray()
+        self._block_list = []
+        # Block ids must all have the same length, the prefix keeps them unique per upload
+        self._block_prefix = uuid.uuid4().hex
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self._buffer += data
+        self.bytes_written += len(data)
+        if len(self._buffer) >= self.block_size:
+            self._stage_block()
+
+    def _stage_block(self):
+        block_id = base64.b64encode(f"{self._block_prefix}{len(self._block_list):08d}".encode()).decode()
+        self.blob_client.stage_block(block_id=block_id, data=bytes(self._buffer))
+        self._block_list.append(BlobBlock(block_id=block_id))
+        self._buffer.clear()
+
+    def close(self):
+        if self._buffer:
+            self._stage_block()
+        self.blob_client.commit_block_list(self._block_list)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Nothing is committed when serialization fails, the staged blocks expire on their own
+        if exc_type is None:
+            self.close()
+
+
+def _dump(value, indent):
+    if indent is None:
+        return json.dumps(value, separators=(',', ':'))
+    # Shift nested lines so the result matches json.dumps(..., indent=indent) of the whole document
+    return json.dumps(value, indent=indent).replace('\n', '\n' + ' ' * indent)
+
+
+def write_json(writer, data, indent=None, ndjson=False):
+    items = data.items() if isinstance(data, dict) else None
+    if ndjson:
+        # One record per line, dict values are written without their keys
+        for record in (data.values() if items is not None else data):
+            writer.write(json.dumps(record, separators=(',', ':')))
+            writer.write('\n')
+        return
+
+    opening, closing = ('{', '}') if items is not None else ('[', ']')
+    newline = '' if indent is None else '\n' + ' ' * indent
+    key_separator = ':' if indent is None else ': '
+    writer.write(opening)
+    first = True
+    for entry in (items if items is not None else data):
+        if not first:
+            writer.write(',')
+        writer.write(newline)
+        if items is not None:
+            key, record = entry
+            writer.write(json.dumps(str(key)) + key_separator + _dump(record, indent))
+        else:
+            writer.write(_dump(entry, indent))
+        first = False
+    if not first and indent is not None:
+        writer.write('\n')
+    writer.write(closing)
+
+
+def upload_json(blob_client, data, indent=None, ndjson=False, block_size=BLOCK_SIZE):
+    # Serializes record by record into staged blocks so memory stays bounded by block_size
+    with BlockBlobWriter(blob_client, block_size) as writer:
+        write_json(writer, data, indent=indent, ndjson=ndjson)
+    return writer.bytes_written
@@ -0,0 +1,67 @@
+import json
+import time
+import hashlib
+import logging
+from shared_code import blob_stream, snapshot
+
+
+def fingerprint(record):
+    return hashlib.sha1(json.dumps(record, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def carry_forward(previous, records, keep):
+    # Keeps the previous records whose keys pass keep(key), for items that could not be fetched this run
+    if previous is None:
+        return 0
+    carried = 0
+    for key, record in previous.get_many([key for key in previous.keys() if key not in records and keep(key)]):
+        records[key] = record
+        carried += 1
+    return carried
+
+
+def diff(previous, records, fingerprints):
+    # Compares fingerprints against the previous snapshot's index, only changed records are read back from it
+    changes = [('added', key, record, None) for key, record in records.items() if key not in previous]
+    changed_keys = {key for key in records if key in previous and previous.meta.get(key) != fingerprints[key]}
+    changes.extend(('changed', key, records[key], old_record) for key, old_record in previous.get_many(changed_keys))
+    changes.extend(('removed', key, None, None) for key in previous.keys() if key not in records)
+    return changes
+
+
+class SnapshotUpdate:
+    # Diffs records (key -> record) against the last snapshot called name, the snapshot is only replaced by commit()
+    # Callers save the delta first and commit after it, so a delta that failed to save is computed again by the next run
+    # keep_missing(key) marks missing keys whose previous record is kept instead of being reported as removed
+    def __init__(self, container_client, name, records, keep_missing=None):
+        self.container_client = container_client
+        self.name = name
+        self.records = records
+        self.previous = snapshot.SnapshotReader.load(container_client, name)
+        if keep_missing is not None:
+            carried = carry_forward(self.previous, records, keep_missing)
+            if carried:
+                logging.warning(f"Kept {carried} previous records of {name} that could not be fetched")
+
+        self.fingerprints = {key: fingerprint(record) for key, record in records.items()}
+        # (change, key, record, old_record) tuples, or None when there was no snapshot to diff against yet
+        self.changes = diff(self.previous, records, self.fingerprints) if self.previous is not None else None
+
+    def commit(self):
+        # Closing the new snapshot deletes the previous data blob
+        snapshot_writer = snapshot.SnapshotWriter(self.container_client, self.name)
+        for key, record in self.records.items():
+            snapshot_writer.add(key, record, self.fingerprints[key])
+        snapshot_writer.close(previous=self.previous)
+
+
+def save_delta(container_client, prefix, entries):
+    # One blob per run under prefix, named by the UTC time so consumers can list the feed in order
+    generated = time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())
+    blob_name = f"{prefix}/{generated}.json"
+    counts = {}
+    for entry in entries:
+        counts[entry['change']] = counts.get(entry['change'], 0) + 1
+    bytes_written = blob_stream.upload_json(container_client.get_blob_client(blob_name), {'generated': generated, 'counts': counts, 'changes': entries})
+    logging.info(f"Saved change feed {blob_name}: {counts or 'no changes'}")
+    return blob_name, bytes_written
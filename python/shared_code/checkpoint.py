@@ -0,0 +1,81 @@
+import gzip
+import json
+import time
+import logging
+from azure.core.exceptions import ResourceNotFoundError
+
+# Checkpoints older than this are discarded and the crawl starts over
+CHECKPOINT_MAX_AGE = 24 * 60 * 60
+
+
+class Checkpoint:
+    # Completed work stored as gzip JSON shards under a prefix, plus a manifest of the shards and the keys each one holds
+    def __init__(self, container_client, prefix, manifest=None):
+        self.container_client = container_client
+        self.prefix = prefix.rstrip('/')
+        self.manifest = manifest or {'created': time.time(), 'shards': []}
+        self.done = {key for shard in self.manifest['shards'] for key in shard['keys']}
+        self._pending = {}
+
+    @classmethod
+    def load(cls, container_client, prefix, max_age=CHECKPOINT_MAX_AGE):
+        checkpoint = cls(container_client, prefix)
+        try:
+            content = container_client.get_blob_client(checkpoint.manifest_blob).download_blob().readall()
+        except ResourceNotFoundError:
+            return checkpoint
+        manifest = json.loads(content)
+        if time.time() - manifest['created'] > max_age:
+            logging.warning(f"Discarding checkpoint {prefix} older than {max_age} seconds")
+            checkpoint.manifest = manifest
+            checkpoint.clear()
+            return cls(container_client, prefix)
+        checkpoint = cls(container_client, prefix, manifest)
+        logging.info(f"Resuming from checkpoint {prefix}: {len(checkpoint.done)} items already done")
+        return checkpoint
+
+    @property
+    def manifest_blob(self):
+        return f"{self.prefix}/manifest.json"
+
+    def add(self, key, record):
+        self._pending[key] = record
+
+    @property
+    def pending_count(self):
+        return len(self._pending)
+
+    def flush(self):
+        if not self._pending:
+            return
+        shard_name = f"{self.prefix}/shard-{len(self.manifest['shards']):05d}.json.gz"
+        data = gzip.compress(json.dumps(self._pending, separators=(',', ':')).encode('utf-8'))
+        self.container_client.get_blob_client(shard_name).upload_blob(data, overwrite=True)
+
+        # The manifest is updated after the shard, so it only ever lists complete shards
+        self.manifest['shards'].append({'name': shard_name, 'keys': list(self._pending)})
+        self.container_client.get_blob_client(self.manifest_blob).upload_blob(json.dumps(self.manifest), overwrite=True)
+        self.done.update(self._pending)
+        logging.info(f"Checkpointed {len(self._pending)} items to {shard_name}, {len(self.done)} done in total")
+        self._pending = {}
+
+    def items(self):
+        # Shards are read one at a time, followed by the items not flushed yet
+        for shard in self.manifest['shards']:
+            content = self.container_client.get_blob_client(shard['name']).download_blob().readall()
+            yield from json.loads(gzip.decompress(content)).items()
+        yield from list(self._pending.items())
+
+    def clear(self):
+        for shard in self.manifest['shards']:
+            try:
+                self.container_client.get_blob_client(shard['name']).delete_blob()
+            except ResourceNotFoundError:
+                pass
+        try:
+            self.container_client.get_blob_client(self.manifest_blob).delete_blob()
+        except ResourceNotFoundError:
+            pass
+        self.manifest = {'created': time.time(), 'shards': []}
+        self.done = set()
+        self._pending = {}
@@ -0,0 +1,82 @@
+import time
+import random
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+EXPORT_JOBS_PATH = 'beta/deviceManagement/reports/exportJobs'
+
+INITIAL_POLL_INTERVAL = 2
+# Full jitter can draw a wait close to 0, this keeps a floor under it
+MIN_POLL_INTERVAL = 0.5
+MAX_POLL_INTERVAL = 60
+EXPORT_JOB_TIMEOUT = 600
+
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+class ExportJobError(Exception):
+    pass
+
+
+def start_export_job(graph_client, report_payload):
+    response = graph_client.post(EXPORT_JOBS_PATH, headers={'Content-Type': 'application/json'}, json=report_payload)
+    if response.status_code not in (200, 201):
+        raise ExportJobError(f"Failed to start export job for {report_payload['reportName']}: HTTP {response.status_code}")
+    return response.json()['id']
+
+
+def _retry_after(response):
+    try:
+        return float(response.headers.get('Retry-After', ''))
+    except ValueError:
+        return None
+
+
+def poll_export_job(graph_client, export_job_id, deadline, initial_interval=INITIAL_POLL_INTERVAL, max_interval=MAX_POLL_INTERVAL):
+    status_url = f"{EXPORT_JOBS_PATH}('{export_job_id}')"
+    interval = initial_interval
+    while True:
+        response = graph_client.get(status_url, endpoint=f"{EXPORT_JOBS_PATH}('{{id}}')")
+        if response.status_code == 200:
+            status_data = response.json()
+            status = status_data.get('status')
+            if status == 'completed':
+                return status_data
+            if status == 'failed':
+                raise ExportJobError(f"Export job {export_job_id} failed")
+        elif response.status_code not in RETRYABLE_STATUS_CODES:
+            raise ExportJobError(f"Failed to get status of export job {export_job_id}: HTTP {response.status_code}")
+
+        # Exponential backoff with full jitter, unless Graph says how long to wait
+        delay = _retry_after(response)
+        if delay is None:
+            delay = max(MIN_POLL_INTERVAL, random.uniform(0, interval))
+            interval = min(interval * 2, max_interval)
+        if time.monotonic() + delay > deadline:
+            raise ExportJobError(f"Export job {export_job_id} did not complete before the deadline")
+        time.sleep(delay)
+
+
+def _run_export_job(graph_client, report_payload, handle_completed, deadline):
+    report_name = report_payload['reportName']
+    started = time.monotonic()
+    result = {'reportName': report_name, 'status': 'failed'}
+    try:
+        export_job_id = start_export_job(graph_client, report_payload)
+        status_data = poll_export_job(graph_client, export_job_id, deadline)
+        result['exportSeconds'] = round(time.monotonic() - started, 1)
+        handle_completed(report_name, status_data)
+        result['status'] = 'completed'
+    except Exception as e:
+        logging.error(f"Export of {report_name} failed: {str(e)}")
+        result['error'] = str(e)
+    result['totalSeconds'] = round(time.monotonic() - started, 1)
+    logging.info(f"Export job latency: {result}")
+    return result
+
+
+def run_export_jobs(graph_client, report_payloads, handle_completed, timeout=EXPORT_JOB_TIMEOUT):
+    # All reports are exported in parallel, handle_completed(report_name, status_data) runs as each one finishes
+    deadline = time.monotonic() + timeout
+    with ThreadPoolExecutor(max_workers=max(1, len(report_payloads))) as executor:
+        return list(executor.map(lambda report_payload: _run_export_job(graph_client, report_payload, handle_completed, deadline), report_payloads))
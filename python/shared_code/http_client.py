@@ -0,0 +1,166 @@
+import time
+import logging
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from shared_code import metrics
+
+DEFAULT_POOL_SIZE = 16
+REQUEST_TIMEOUT = 60
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+# Sessions are kept at module level so warm invocations of the same worker reuse their connections
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def _build_adapter(pool_size):
+    retry = Retry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=RETRY_STATUS_CODES,
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    return HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+
+
+def get_session(name, pool_size=DEFAULT_POOL_SIZE):
+    with _sessions_lock:
+        session, current_pool_size = _sessions.get(name, (None, 0))
+        if session is None:
+            session = requests.Session()
+            session.headers['Accept-Encoding'] = 'gzip, deflate'
+        if pool_size > current_pool_size:
+            # Grow the pool so every concurrent worker can hold a keep-alive connection
+            old_adapter = session.adapters.get('https://') if current_pool_size else None
+            adapter = _build_adapter(pool_size)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _sessions[name] = (session, pool_size)
+            if old_adapter is not None:
+                # Close the idle keep-alive sockets of the smaller pool instead of leaving them to garbage collection
+                old_adapter.close()
+                logging.info(f"Grew the {name} connection pool from {current_pool_size} to {pool_size}, connection stats restart from 0")
+        return session
+
+
+def connection_stats(session):
+    # Counts are per process, not per run: they add up over the warm invocations sharing the session since its pool was last grown
+    # http:// and https:// share one adapter, so a single pool manager holds every host pool
+    pools = session.get_adapter('https://').poolmanager.pools
+    opened = 0
+    requests_sent = 0
+    for key in pools.keys():
+        pool = pools.get(key)
+        if pool is not None:
+            opened += pool.num_connections
+            requests_sent += pool.num_requests
+    return {'connections_opened': opened, 'connections_reused': max(requests_sent - opened, 0), 'requests': requests_sent}
+
+
+def retry_history(response):
+    # urllib3 keeps the attempts it retried on the raw response
+    retries = getattr(response.raw, 'retries', None)
+    return retries.history if retries is not None else ()
+
+
+def bytes_received(response):
+    # Content-Length is the size on the wire, streamed bodies without one are not read here
+    content_length = response.headers.get('Content-Length')
+    if content_length is not None:
+        return int(content_length)
+    return len(response.content) if response._content_consumed else 0
+
+
+def bytes_sent(response):
+    body = response.request.body
+    if body is None:
+        return 0
+    return len(body.encode('utf-8') if isinstance(body, str) else body)
+
+
+class ApiClient:
+    def __init__(self, base_url, name, pool_size=DEFAULT_POOL_SIZE, auth_scheme=None, timeout=REQUEST_TIMEOUT, token_provider=None, run_metrics=None, throttle_policy=None):
+        self.base_url = base_url.rstrip('/')
+        self.name = name
+        self.session = get_session(name, pool_size)
+        self.auth_scheme = auth_scheme
+        self.timeout = timeout
+        self.token = None
+        self.token_provider = token_provider
+        # Every request is recorded here, a client created without run metrics keeps its own
+        self.metrics = run_metrics if run_metrics is not None else metrics.RunMetrics(name)
+        # Optional client-side rate and concurrency limits per endpoint family
+        self.throttle_policy = throttle_policy
+
+    def url(self, path):
+        if path.startswith('http://') or path.startswith('https://'):
+            return path
+        return f"{self.base_url}/{path.lstrip('/')}"
+
+    def get_token(self):
+        if self.token_provider is not None:
+            return self.token_provider.get_token()
+        return self.token
+
+    def auth_headers(self, token=None):
+        if token is None:
+            token = self.get_token()
+        if token is None:
+            return {}
+        if self.auth_scheme:
+            return {'Authorization': f"{self.auth_scheme} {token}"}
+        return {'Authorization': token}
+
+    def endpoint_name(self, path):
+        # Query strings are dropped so paging requests of a collection share one endpoint
+        return path.split('?', 1)[0].rstrip('/') or '/'
+
+    def request(self, method, path, headers=None, authenticate=True, endpoint=None, **kwargs):
+        # endpoint is the path template the request is recorded under, e.g. DiscoveredAccounts/{id}
+        kwargs.setdefault('timeout', self.timeout)
+        endpoint = f"{method} {endpoint or self.endpoint_name(path)}"
+        token = self.get_token() if authenticate else None
+        response = self._send(method, path, token, headers, endpoint, **kwargs)
+
+        # A rejected token is refreshed once and the request retried with the new one
+        if response.status_code == 401 and token is not None and self.token_provider is not None:
+            logging.warning(f"HTTP 401 from {self.name}, refreshing the token and retrying")
+            self.token_provider.invalidate(token)
+            response.close()
+            response = self._send(method, path, self.token_provider.get_token(), headers, endpoint, **kwargs)
+        return response
+
+    def _send(self, method, path, token, headers, endpoint, **kwargs):
+        request_headers = self.auth_headers(token) if token is not None else {}
+        if headers:
+            request_headers.update(headers)
+        throttle = self.throttle_policy.for_endpoint(endpoint.split(' ', 1)[1]) if self.throttle_policy is not None else None
+        throttle_started = throttle.acquire() if throttle is not None else None
+        started = time.perf_counter()
+        response = None
+        try:
+            response = self.session.request(method, self.url(path), headers=request_headers, **kwargs)
+        finally:
+            seconds = time.perf_counter() - started
+            if response is None:
+                self.metrics.record_request(endpoint, None, seconds)
+                if throttle is not None:
+                    throttle.release(throttle_started, seconds, None)
+        history = retry_history(response)
+        self.metrics.record_request(endpoint, response.status_code, seconds,
+                                    retries=len(history), bytes_in=bytes_received(response), bytes_out=bytes_sent(response))
+        if throttle is not None:
+            throttle.release(throttle_started, seconds, response.status_code, [attempt.status for attempt in history])
+        return response
+
+    def get(self, path, **kwargs):
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request('POST', path, **kwargs)
+
+    def connection_stats(self):
+        return connection_stats(self.session)
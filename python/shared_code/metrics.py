@@ -0,0 +1,151 @@
+import os
+import json
+import time
+import bisect
+import logging
+import threading
+from collections import Counter
+from contextlib import contextmanager
+
+# Upper bounds in seconds of the request latency histogram buckets, slower requests land in an overflow bucket
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Per-item log lines are only written for one in this many items of a kind, 0 turns them off
+ITEM_LOG_INTERVAL = int(os.environ.get("METRICS_ITEM_LOG_INTERVAL", "1000"))
+
+
+class LatencyHistogram:
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, fraction):
+        # Upper bound of the bucket holding the observation at that rank, capped by the slowest observation
+        rank = fraction * self.count
+        seen = 0
+        for bucket, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= rank and bucket_count:
+                return min(LATENCY_BUCKETS[bucket], self.max) if bucket < len(LATENCY_BUCKETS) else self.max
+        return self.max
+
+    def summary(self):
+        if not self.count:
+            return {}
+        return {
+            'mean': round(self.total / self.count, 4),
+            'p50': round(self.percentile(0.5), 4),
+            'p95': round(self.percentile(0.95), 4),
+            'p99': round(self.percentile(0.99), 4),
+            'max': round(self.max, 4),
+            'buckets': {str(bound): count for bound, count in zip(LATENCY_BUCKETS + ('inf',), self.counts) if count},
+        }
+
+
+class EndpointStats:
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.retries = 0
+        self.statuses = Counter()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.latency = LatencyHistogram()
+
+    def summary(self):
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'retries': self.retries,
+            'statuses': dict(self.statuses),
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'latency': self.latency.summary(),
+        }
+
+
+class RunMetrics:
+    # Phase spans, per-endpoint request stats and counters of one function run, emitted once as a JSON summary
+    def __init__(self, name):
+        self.name = name
+        self.started = time.time()
+        self._started = time.perf_counter()
+        self.spans = {}
+        self.endpoints = {}
+        self.counters = Counter()
+        self._item_counts = Counter()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, phase):
+        # Spans of the same phase add up, phases running on several threads report their summed time
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                span = self.spans.setdefault(phase, {'seconds': 0.0, 'count': 0})
+                span['seconds'] += elapsed
+                span['count'] += 1
+
+    def record_request(self, endpoint, status, seconds, retries=0, bytes_in=0, bytes_out=0):
+        # status is None when the request raised instead of returning a response
+        with self._lock:
+            stats = self.endpoints.get(endpoint)
+            if stats is None:
+                stats = self.endpoints[endpoint] = EndpointStats()
+            stats.requests += 1
+            stats.retries += retries
+            stats.statuses[str(status) if status is not None else 'exception'] += 1
+            if status is None or status >= 400:
+                stats.errors += 1
+            stats.bytes_in += bytes_in
+            stats.bytes_out += bytes_out
+            stats.latency.observe(seconds)
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def log_item(self, kind, message):
+        # Sampled replacement for logging every item, the first item of a kind and then every ITEM_LOG_INTERVAL-th are logged
+        if not ITEM_LOG_INTERVAL:
+            return
+        with self._lock:
+            self._item_counts[kind] += 1
+            item_count = self._item_counts[kind]
+        if item_count == 1 or item_count % ITEM_LOG_INTERVAL == 0:
+            logging.info(f"{message} ({kind} #{item_count})")
+
+    def summary(self, **extra):
+        with self._lock:
+            endpoints = {endpoint: stats.summary() for endpoint, stats in sorted(self.endpoints.items())}
+            return {
+                'run': self.name,
+                'started': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(self.started)),
+                'seconds': round(time.perf_counter() - self._started, 3),
+                'spans': {phase: {'seconds': round(span['seconds'], 3), 'count': span['count']} for phase, span in self.spans.items()},
+                'requests': sum(stats['requests'] for stats in endpoints.values()),
+                'errors': sum(stats['errors'] for stats in endpoints.values()),
+                'retries': sum(stats['retries'] for stats in endpoints.values()),
+                'bytes_in': sum(stats['bytes_in'] for stats in endpoints.values()),
+                'bytes_out': sum(stats['bytes_out'] for stats in endpoints.values()),
+                'endpoints': endpoints,
+                'counters': dict(self.counters),
+                **extra,
+            }
+
+    def emit(self, **extra):
+        # A single structured line per run, extra fields are added to the summary as they are
+        summary = self.summary(**extra)
+        logging.info(f"Run metrics: {json.dumps(summary, separators=(',', ':'))}")
+        return summary
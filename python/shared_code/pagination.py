@@ -0,0 +1,37 @@
+import math
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+PAGE_SIZE = 1000
+DEFAULT_MAX_WORKERS = 8
+
+
+def get_count(client, path):
+    count_response = client.get(path)
+    count_response.raise_for_status()
+    return count_response.json()["count"]
+
+
+def get_page_offsets(count, page_size=PAGE_SIZE):
+    # ceil avoids requesting an extra empty page when count is an exact multiple of page_size
+    return [page * page_size for page in range(math.ceil(count / page_size))]
+
+
+def fetch_page(client, path, offset, page_size=PAGE_SIZE, endpoint=None):
+    separator = '&' if '?' in path else '?'
+    page_response = client.get(f"{path}{separator}offset={offset}&limit={page_size}", endpoint=endpoint)
+    page_response.raise_for_status()
+    return page_response.json()["value"]
+
+
+def get_all_pages(client, path, count, page_size=PAGE_SIZE, max_workers=DEFAULT_MAX_WORKERS):
+    offsets = get_page_offsets(count, page_size)
+    if not offsets:
+        return []
+
+    # Pages are fetched concurrently but merged back in offset order
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(offsets)))) as executor:
+        pages = list(executor.map(lambda offset: fetch_page(client, path, offset, page_size), offsets))
+
+    logging.info(f"Fetched {len(pages)} pages of {path}")
+    return [item for page in pages for item in page]
@@ -0,0 +1,139 @@
+import gzip
+import json
+import time
+import uuid
+import logging
+import threading
+from collections import OrderedDict
+from collections.abc import Mapping
+from azure.core.exceptions import ResourceNotFoundError
+from shared_code import blob_stream
+
+SNAPSHOT_VERSION = 1
+
+# Records per gzip member, each member can be range-read and decompressed on its own
+CHUNK_RECORDS = 500
+
+# Decompressed chunks kept in memory by a reader
+CACHED_CHUNKS = 8
+
+
+def index_blob_name(name):
+    return f"{name}.index.json.gz"
+
+
+class SnapshotWriter:
+    # Writes records as gzip-compressed NDJSON chunks plus a separate index of keys, chunk ranges and per-key metadata
+    def __init__(self, container_client, name, chunk_records=CHUNK_RECORDS):
+        self.container_client = container_client
+        self.name = name
+        # Each write gets its own data blob so the previous one stays readable until the new index replaces it
+        self.data_blob = f"{name}.{time.strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}.ndjson.gz"
+        self.chunk_records = chunk_records
+        self._writer = blob_stream.BlockBlobWriter(container_client.get_blob_client(self.data_blob))
+        self._pending = []
+        self._chunks = []
+        self._keys = {}
+        self._meta = {}
+
+    def add(self, key, record, meta=None):
+        self._pending.append((key, record))
+        if meta is not None:
+            self._meta[key] = meta
+        if len(self._pending) >= self.chunk_records:
+            self._flush_chunk()
+
+    def _flush_chunk(self):
+        lines = '\n'.join(json.dumps([key, record], separators=(',', ':')) for key, record in self._pending)
+        data = gzip.compress(lines.encode('utf-8'))
+        chunk_number = len(self._chunks)
+        self._chunks.append([self._writer.bytes_written, len(data)])
+        for key, _ in self._pending:
+            self._keys[key] = chunk_number
+        self._writer.write(data)
+        self._pending = []
+
+    def close(self, previous=None):
+        if self._pending:
+            self._flush_chunk()
+        self._writer.close()
+
+        # The index is written last so readers never see it point at a partially written data blob
+        index = {'version': SNAPSHOT_VERSION, 'data_blob': self.data_blob, 'chunks': self._chunks, 'keys': self._keys, 'meta': self._meta}
+        index_blob_client = self.container_client.get_blob_client(index_blob_name(self.name))
+        index_blob_client.upload_blob(gzip.compress(json.dumps(index, separators=(',', ':')).encode('utf-8')), overwrite=True)
+        logging.info(f"Saved snapshot {self.name}: {len(self._keys)} records in {len(self._chunks)} chunks")
+
+        if previous is not None and previous.data_blob != self.data_blob:
+            try:
+                self.container_client.get_blob_client(previous.data_blob).delete_blob()
+            except ResourceNotFoundError:
+                pass
+
+
+class SnapshotReader(Mapping):
+    # Read-only mapping over a snapshot, the key set comes from the index and records are fetched per chunk on demand
+    def __init__(self, container_client, index):
+        self.container_client = container_client
+        self.data_blob = index['data_blob']
+        self.meta = index.get('meta', {})
+        self._chunks = index['chunks']
+        self._keys = index['keys']
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, container_client, name):
+        try:
+            content = container_client.get_blob_client(index_blob_name(name)).download_blob().readall()
+        except ResourceNotFoundError:
+            logging.warning(f"Snapshot index not found: {index_blob_name(name)}")
+            return None
+        index = json.loads(gzip.decompress(content))
+        if index.get('version') != SNAPSHOT_VERSION:
+            logging.warning(f"Unsupported snapshot version {index.get('version')} for {name}")
+            return None
+        return cls(container_client, index)
+
+    def keys(self):
+        return self._keys.keys()
+
+    def _load_chunk(self, chunk_number):
+        with self._lock:
+            if chunk_number in self._cache:
+                self._cache.move_to_end(chunk_number)
+                return self._cache[chunk_number]
+        offset, length = self._chunks[chunk_number]
+        data = self.container_client.get_blob_client(self.data_blob).download_blob(offset=offset, length=length).readall()
+        records = dict(json.loads(line) for line in gzip.decompress(data).decode('utf-8').split('\n') if line)
+        with self._lock:
+            self._cache[chunk_number] = records
+            if len(self._cache) > CACHED_CHUNKS:
+                self._cache.popitem(last=False)
+        return records
+
+    def __getitem__(self, key):
+        return self._load_chunk(self._keys[key])[key]
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def get_many(self, keys):
+        # Yields (key, record) for the keys present, grouped by chunk so each chunk is read once
+        for key in sorted((key for key in keys if key in self._keys), key=self._keys.get):
+            yield key, self[key]
+
+    def items(self):
+        # Walk the data chunk by chunk so a full scan only holds one chunk at a time
+        for chunk_number in range(len(self._chunks)):
+            yield from self._load_chunk(chunk_number).items()
+
+    def values(self):
+        for _, record in self.items():
+            yield record
@@ -0,0 +1,30 @@
+import unittest
+
+from shared_code import throttle
+
+
+class GetPolicyTest(unittest.TestCase):
+    def setUp(self):
+        self.key = ("test", self.id())
+
+    def tearDown(self):
+        throttle._policies.pop(self.key, None)
+
+    def test_callers_with_the_same_settings_share_one_policy(self):
+        config = {'*': {'rate': 50}}
+        policy = throttle.get_policy(self.key, config)
+        throttle_for_safes = policy.for_endpoint("Safes/{safeUrlId}/Members")
+        self.assertIs(throttle.get_policy(self.key, dict(config)), policy)
+        self.assertIs(policy.for_endpoint("Safes"), throttle_for_safes)
+
+    def test_conflicting_settings_are_rejected(self):
+        policy = throttle.get_policy(self.key, {'*': {'rate': 50}})
+        with self.assertRaises(ValueError):
+            throttle.get_policy(self.key, {'*': {'rate': 10}})
+        with self.assertRaises(ValueError):
+            throttle.get_policy(self.key, {'*': {'rate': 50}}, defaults={'max_concurrency': 32})
+        self.assertIs(throttle.get_policy(self.key, {'*': {'rate': 50}}), policy)
+
+
+if __name__ == '__main__':
+    unittest.main()
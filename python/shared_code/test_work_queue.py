@@ -0,0 +1,86 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from shared_code import work_queue
+
+
+def _receive_all(path, queue_name):
+    # Consumer process, claims messages until the queue is empty and returns their ids
+    queue = work_queue.SqliteWorkQueue(path, queue_name)
+    received = []
+    while True:
+        message = queue.receive()
+        if message is None:
+            return received
+        received.append(message[1]['id'])
+        queue.delete(message[0])
+
+
+class SqliteWorkQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "queue.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_processes_never_claim_the_same_message(self):
+        queue = work_queue.SqliteWorkQueue(self.path, "shards")
+        for message_id in range(600):
+            queue.send({'id': message_id})
+        with multiprocessing.Pool(3) as pool:
+            results = pool.starmap(_receive_all, [(self.path, "shards")] * 3)
+        received = [message_id for result in results for message_id in result]
+        self.assertEqual(len(received), 600)
+        self.assertEqual(set(received), set(range(600)))
+
+    def test_unfinished_message_is_handed_out_again_after_the_visibility_timeout(self):
+        queue = work_queue.SqliteWorkQueue(self.path, "shards", visibility_timeout=0.2)
+        queue.send({'id': 1})
+        message_id, message, dequeue_count = queue.receive()
+        self.assertEqual((message, dequeue_count), ({'id': 1}, 1))
+        self.assertIsNone(queue.receive())
+        time.sleep(0.3)
+        self.assertEqual(queue.receive(), (message_id, {'id': 1}, 2))
+
+    def test_released_message_is_visible_at_once(self):
+        queue = work_queue.SqliteWorkQueue(self.path, "shards")
+        queue.send({'id': 1})
+        message_id, _, _ = queue.receive()
+        queue.release(message_id)
+        self.assertEqual(queue.receive(), (message_id, {'id': 1}, 2))
+
+    def test_queues_in_one_file_are_separate(self):
+        work_queue.SqliteWorkQueue(self.path, "other").send({'id': 1})
+        self.assertIsNone(work_queue.SqliteWorkQueue(self.path, "shards").receive())
+
+
+class DrainTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.queue = work_queue.SqliteWorkQueue(os.path.join(self.directory, "queue.db"), "shards")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_failing_message_is_retried_then_dropped(self):
+        self.queue.send({'id': 1})
+        self.queue.send({'id': 2})
+        deliveries = []
+
+        def handle_message(message, dequeue_count):
+            deliveries.append((message['id'], dequeue_count))
+            if message['id'] == 1:
+                raise ValueError("poison")
+
+        work_queue.drain(self.queue, handle_message, workers=2)
+        self.assertEqual(sorted(deliveries), [(1, count) for count in range(1, work_queue.MAX_DEQUEUE_COUNT + 1)] + [(2, 1)])
+        self.assertIsNone(self.queue.receive())
+
+
+if __name__ == '__main__':
+    unittest.main()
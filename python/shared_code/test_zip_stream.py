@@ -0,0 +1,105 @@
+import io
+import os
+import random
+import unittest
+import zipfile
+
+from shared_code import zip_stream
+
+
+class _Unseekable:
+    # Write-only stream, zipfile falls back to data descriptors after each member like a streaming exporter does
+    def __init__(self):
+        self.buffer = io.BytesIO()
+
+    def write(self, data):
+        return self.buffer.write(data)
+
+    def flush(self):
+        pass
+
+    def getvalue(self):
+        return self.buffer.getvalue()
+
+
+def _build_zip(members, seekable=True, compression=zipfile.ZIP_DEFLATED, force_zip64=False):
+    output = io.BytesIO() if seekable else _Unseekable()
+    with zipfile.ZipFile(output, 'w', compression=compression) as zip_file:
+        for name, data in members:
+            with zip_file.open(name, 'w', force_zip64=force_zip64) as member:
+                member.write(data)
+    return output.getvalue()
+
+
+def _chunked(data, size):
+    return [data[start:start + size] for start in range(0, len(data), size)]
+
+
+def _read_members(data, chunk_size=777, member_chunk_size=zip_stream.CHUNK_SIZE):
+    return [(name, b''.join(member_data)) for name, member_data in zip_stream.iter_members(_chunked(data, chunk_size), member_chunk_size)]
+
+
+class IterMembersTest(unittest.TestCase):
+    def setUp(self):
+        generator = random.Random(0)
+        csv_rows = ''.join(f"device-{i},app-{i % 97},{generator.random()}\n" for i in range(20000)).encode()
+        self.members = [
+            ('AppInvRawData.csv', csv_rows),
+            ('random.bin', os.urandom(100000)),
+            ('empty.csv', b''),
+            ('näme.txt', b'utf-8 name'),
+        ]
+
+    def assert_round_trip(self, **build_options):
+        data = _build_zip(self.members, **build_options)
+        self.assertEqual(_read_members(data), self.members)
+        self.assertEqual(_read_members(data, chunk_size=len(data)), self.members)
+
+    def test_seekable_deflated(self):
+        self.assert_round_trip()
+
+    def test_unseekable_deflated_uses_data_descriptors(self):
+        self.assert_round_trip(seekable=False)
+
+    def test_force_zip64(self):
+        self.assert_round_trip(force_zip64=True)
+
+    def test_unseekable_force_zip64(self):
+        self.assert_round_trip(seekable=False, force_zip64=True)
+
+    def test_seekable_stored(self):
+        self.assert_round_trip(compression=zipfile.ZIP_STORED)
+
+    def test_unseekable_stored_is_rejected(self):
+        data = _build_zip(self.members, seekable=False, compression=zipfile.ZIP_STORED)
+        with self.assertRaises(ValueError):
+            _read_members(data)
+
+    def test_member_chunks_are_capped(self):
+        data = _build_zip(self.members)
+        for _, member_data in zip_stream.iter_members(_chunked(data, 777), chunk_size=4096):
+            for chunk in member_data:
+                self.assertLessEqual(len(chunk), 4096)
+
+    def test_unconsumed_members_are_skipped(self):
+        data = _build_zip(self.members, seekable=False)
+        names = [name for name, _ in zip_stream.iter_members(_chunked(data, 777))]
+        self.assertEqual(names, [name for name, _ in self.members])
+
+    def test_crc_mismatch(self):
+        data = bytearray(_build_zip([('a.txt', b'abcdef' * 100)], compression=zipfile.ZIP_STORED))
+        data[data.index(b'abcdef')] ^= 0xFF
+        with self.assertRaises(ValueError):
+            _read_members(bytes(data))
+
+    def test_truncated_stream(self):
+        data = _build_zip(self.members)
+        with self.assertRaises(ValueError):
+            _read_members(data[:len(data) // 2])
+
+    def test_empty_archive(self):
+        self.assertEqual(_read_members(_build_zip([])), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,183 @@
+import os
+import json
+import time
+import logging
+import threading
+from collections import deque
+
+# Statuses, final or retried by urllib3, that mean the server is overloaded
+CONGESTION_STATUS_CODES = (429, 503)
+
+# Settings of an endpoint family, overridden per family by the config passed to get_policy
+DEFAULT_SETTINGS = {
+    # Requests per second, 0 leaves the rate unlimited
+    'rate': 0,
+    # Requests that may be sent back to back before the rate applies, defaults to one second worth of requests
+    'burst': 0,
+    'initial_concurrency': 4,
+    'min_concurrency': 1,
+    'max_concurrency': 16,
+    # The limit is halved when the p95 latency of a window exceeds this multiple of the best p95 seen
+    'latency_tolerance': 1.5,
+    # Successful requests per latency window
+    'latency_window': 20,
+}
+
+# Client-side limits of the CyberArk PVWA per endpoint family as JSON, "*" applies to every family,
+# e.g. {"*": {"rate": 50}, "DiscoveredAccounts": {"max_concurrency": 32}}
+# Read here once so every function calling the PVWA builds the same policy and shares its limiters
+CYBERARK_THROTTLE_CONFIG = json.loads(os.environ.get("CYBERARK_THROTTLE_CONFIG", "{}"))
+
+# The best p95 is allowed to grow by this factor per window, so a server that got slower for good becomes the new normal
+BASELINE_DRIFT = 1.01
+
+# Policies are kept at module level so warm invocations of the same worker start from the limits they learned
+_policies = {}
+_policies_lock = threading.Lock()
+
+
+class TokenBucket:
+    # Blocking rate limiter, callers reserve a token and sleep until it is due so they are served in order
+    def __init__(self, rate, burst=0):
+        self.rate = rate
+        self.burst = burst or max(1, rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+            if delay:
+                self.waits += 1
+                self.wait_seconds += delay
+        if delay:
+            time.sleep(delay)
+
+
+class AdaptiveConcurrency:
+    # AIMD limit on requests in flight: +1 per limit's worth of healthy responses, halved on congestion or a p95 spike
+    def __init__(self, initial, minimum, maximum, latency_tolerance, latency_window):
+        self.limit = float(min(max(initial, minimum), maximum))
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_tolerance = latency_tolerance
+        self.in_flight = 0
+        self.decreases = 0
+        self.baseline_p95 = None
+        self._latencies = deque(maxlen=latency_window)
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+            return time.monotonic()
+
+    def release(self, started, seconds, congested):
+        with self._condition:
+            self.in_flight -= 1
+            if congested:
+                self._decrease(started, "server congestion")
+            else:
+                self._latencies.append(seconds)
+                if len(self._latencies) == self._latencies.maxlen:
+                    self._check_latency(started)
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+    def _check_latency(self, started):
+        latencies = sorted(self._latencies)
+        self._latencies.clear()
+        p95 = latencies[int(0.95 * (len(latencies) - 1))]
+        if self.baseline_p95 is not None and p95 > self.baseline_p95 * self.latency_tolerance:
+            self._decrease(started, f"p95 latency {p95:.3f}s over baseline {self.baseline_p95:.3f}s")
+        self.baseline_p95 = p95 if self.baseline_p95 is None else min(p95, self.baseline_p95 * BASELINE_DRIFT)
+
+    def _decrease(self, started, reason):
+        # Responses to requests sent before the last decrease already reflect it, so they do not lower the limit again
+        if started < self._last_decrease:
+            return
+        self.limit = max(self.minimum, self.limit / 2)
+        self._last_decrease = time.monotonic()
+        # Latencies measured at the old limit would be held against the new one
+        self._latencies.clear()
+        self.decreases += 1
+        logging.warning(f"Lowering concurrency limit to {int(self.limit)} after {reason}")
+
+
+class Throttle:
+    # Settings are the keys of DEFAULT_SETTINGS
+    def __init__(self, rate, burst, initial_concurrency, min_concurrency, max_concurrency, latency_tolerance, latency_window):
+        self.bucket = TokenBucket(rate, burst)
+        self.concurrency = AdaptiveConcurrency(initial_concurrency, min_concurrency, max_concurrency, latency_tolerance, latency_window)
+
+    def acquire(self):
+        # Returns the start time to hand back to release
+        started = self.concurrency.acquire()
+        self.bucket.acquire()
+        return started
+
+    def release(self, started, seconds, status, retried_statuses=()):
+        # status is None when the request raised, that counts as congestion like 429 and 503 do
+        congested = status is None or status in CONGESTION_STATUS_CODES or any(retried in CONGESTION_STATUS_CODES for retried in retried_statuses)
+        self.concurrency.release(started, seconds, congested)
+
+    def stats(self):
+        return {
+            'limit': int(self.concurrency.limit),
+            'decreases': self.concurrency.decreases,
+            'baseline_p95': self.concurrency.baseline_p95,
+            'rate': self.bucket.rate,
+            'rate_waits': self.bucket.waits,
+            'rate_wait_seconds': round(self.bucket.wait_seconds, 3),
+        }
+
+
+class ThrottlePolicy:
+    # One Throttle per endpoint family, the family is the first segment of the endpoint path, e.g. Safes for Safes/{safeUrlId}/Members
+    def __init__(self, config=None, defaults=None):
+        self.config = config or {}
+        self.defaults = {**DEFAULT_SETTINGS, **(defaults or {})}
+        self._throttles = {}
+        self._lock = threading.Lock()
+
+    def family(self, endpoint):
+        return endpoint.split('/', 1)[0]
+
+    def for_endpoint(self, endpoint):
+        family = self.family(endpoint)
+        with self._lock:
+            throttle = self._throttles.get(family)
+            if throttle is None:
+                # "*" holds the settings shared by every family, a family's own entry overrides them
+                throttle = Throttle(**{**self.defaults, **self.config.get('*', {}), **self.config.get(family, {})})
+                self._throttles[family] = throttle
+            return throttle
+
+    def stats(self):
+        with self._lock:
+            return {family: throttle.stats() for family, throttle in self._throttles.items()}
+
+
+def get_policy(key, config=None, defaults=None):
+    # One policy per key for the life of the process, so every client of the same server shares its limiters and the limits they learned
+    # defaults are settings under the config, every caller of a key must pass the same config and defaults
+    with _policies_lock:
+        policy = _policies.get(key)
+        if policy is None:
+            policy = ThrottlePolicy(config, defaults)
+            _policies[key] = policy
+        elif policy.config != (config or {}) or policy.defaults != {**DEFAULT_SETTINGS, **(defaults or {})}:
+            raise ValueError(f"Conflicting throttle settings for {key}: {config} and {defaults} differ from the policy already in use")
+        return policy
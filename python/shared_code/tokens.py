@@ -0,0 +1,53 @@
+import time
+import logging
+import threading
+
+# Tokens are refreshed this many seconds before they expire
+REFRESH_MARGIN = 60
+
+# Providers are kept at module level so warm invocations of the same worker reuse their tokens
+_providers = {}
+_providers_lock = threading.Lock()
+
+
+class TokenProvider:
+    # Caches a token until shortly before it expires, fetch_token() returns (token, lifetime_seconds)
+    def __init__(self, fetch_token, refresh_margin=REFRESH_MARGIN):
+        self.fetch_token = fetch_token
+        self.refresh_margin = refresh_margin
+        self._token = None
+        self._expires_at = 0
+        self._lock = threading.Lock()
+
+    def _is_fresh(self):
+        return self._token is not None and time.monotonic() < self._expires_at - self.refresh_margin
+
+    def get_token(self):
+        if self._is_fresh():
+            return self._token
+        # Only one thread logs on, the others wait for its token
+        with self._lock:
+            if not self._is_fresh():
+                token, lifetime = self.fetch_token()
+                self._token = token
+                self._expires_at = time.monotonic() + lifetime
+                logging.info(f"Obtained a new token valid for {lifetime} seconds")
+            return self._token
+
+    def invalidate(self, token):
+        # Only drop the token that was rejected, so a burst of 401s leads to a single refresh
+        with self._lock:
+            if self._token == token:
+                self._token = None
+
+
+def get_provider(key, fetch_token, refresh_margin=REFRESH_MARGIN):
+    with _providers_lock:
+        provider = _providers.get(key)
+        if provider is None:
+            provider = TokenProvider(fetch_token, refresh_margin)
+            _providers[key] = provider
+        else:
+            # The cached token is kept, only the way to fetch the next one is updated
+            provider.fetch_token = fetch_token
+        return provider
@@ -0,0 +1,100 @@
+import json
+import time
+import logging
+import sqlite3
+import threading
+
+# A message is handed out this many times before it is dropped as poison, like the Functions queue trigger does
+MAX_DEQUEUE_COUNT = 5
+
+# Seconds a received message stays hidden from other consumers, after that it is handed out again as if its consumer died
+VISIBILITY_TIMEOUT = 10 * 60
+
+
+class StorageWorkQueue:
+    # Azure Storage queue consumed by a queueTrigger function
+    def __init__(self, connection_string, queue_name):
+        from azure.storage.queue import QueueClient, TextBase64EncodePolicy
+        from azure.core.exceptions import ResourceExistsError
+
+        # The queue trigger expects base64 encoded messages by default
+        self.queue_client = QueueClient.from_connection_string(connection_string, queue_name, message_encode_policy=TextBase64EncodePolicy())
+        try:
+            self.queue_client.create_queue()
+        except ResourceExistsError:
+            pass
+
+    def send(self, message):
+        self.queue_client.send_message(json.dumps(message))
+
+
+class SqliteWorkQueue:
+    # Local stand-in for a storage queue, backed by a SQLite file so separate processes can share it
+    def __init__(self, path, queue_name, visibility_timeout=VISIBILITY_TIMEOUT):
+        self.path = path
+        self.queue_name = queue_name
+        self.visibility_timeout = visibility_timeout
+        with self._connect() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS queue_messages (id INTEGER PRIMARY KEY AUTOINCREMENT, queue TEXT NOT NULL, "
+                               "body TEXT NOT NULL, visible_at REAL NOT NULL DEFAULT 0, dequeue_count INTEGER NOT NULL DEFAULT 0)")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def send(self, message):
+        with self._connect() as connection:
+            connection.execute("INSERT INTO queue_messages (queue, body) VALUES (?, ?)", (self.queue_name, json.dumps(message)))
+
+    def receive(self):
+        now = time.time()
+        with self._connect() as connection:
+            # The write lock is taken before the SELECT, so two processes can never claim the same message
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute("SELECT id, body, dequeue_count FROM queue_messages WHERE queue = ? AND visible_at <= ? ORDER BY id LIMIT 1",
+                                     (self.queue_name, now)).fetchone()
+            if row is None:
+                return None
+            connection.execute("UPDATE queue_messages SET visible_at = ?, dequeue_count = dequeue_count + 1 WHERE id = ?",
+                               (now + self.visibility_timeout, row[0]))
+            return row[0], json.loads(row[1]), row[2] + 1
+
+    def delete(self, message_id):
+        with self._connect() as connection:
+            connection.execute("DELETE FROM queue_messages WHERE id = ?", (message_id,))
+
+    def release(self, message_id):
+        with self._connect() as connection:
+            connection.execute("UPDATE queue_messages SET visible_at = 0 WHERE id = ?", (message_id,))
+
+
+def get_work_queue(queue_name, backend, connection_string=None):
+    # backend is "storage" or "sqlite:<path to database file>"
+    if backend.startswith("sqlite:"):
+        return SqliteWorkQueue(backend[len("sqlite:"):], queue_name)
+    return StorageWorkQueue(connection_string, queue_name)
+
+
+def drain(work_queue, handle_message, workers):
+    # Runs queued messages on local worker threads, standing in for the queue-triggered function instances
+    # handle_message(message, dequeue_count) is called with the delivery count, raising hands the message out again
+    def worker():
+        while True:
+            received = work_queue.receive()
+            if received is None:
+                return
+            message_id, message, dequeue_count = received
+            try:
+                handle_message(message, dequeue_count)
+                work_queue.delete(message_id)
+            except Exception as e:
+                logging.error(f"Error handling queue message {message}: {str(e)}")
+                if dequeue_count >= MAX_DEQUEUE_COUNT:
+                    work_queue.delete(message_id)
+                else:
+                    work_queue.release(message_id)
+
+    threads = [threading.Thread(target=worker) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
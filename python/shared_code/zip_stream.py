@@ -0,0 +1,137 @@
+import zlib
+import struct
+
+LOCAL_FILE_HEADER_SIGNATURE = b'PK\x03\x04'
+DATA_DESCRIPTOR_SIGNATURE = b'PK\x07\x08'
+ZIP64_EXTRA_FIELD_ID = 0x0001
+CHUNK_SIZE = 1024 * 1024
+
+METHOD_STORED = 0
+METHOD_DEFLATED = 8
+
+FLAG_ENCRYPTED = 0x01
+FLAG_DATA_DESCRIPTOR = 0x08
+FLAG_UTF8_NAME = 0x800
+
+
+class _ChunkReader:
+    # Exact-size reads over an iterator of byte chunks, with push back for over-read data
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = bytearray()
+
+    def _fill(self, size):
+        while len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+
+    def read(self, size):
+        self._fill(size)
+        if size >= len(self._buffer):
+            data = bytes(self._buffer)
+            self._buffer.clear()
+            return data
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def read_exact(self, size):
+        data = self.read(size)
+        if len(data) != size:
+            raise ValueError("Unexpected end of ZIP stream")
+        return data
+
+    def read_chunk(self, max_size):
+        self._fill(1)
+        return self.read(min(max_size, len(self._buffer)))
+
+    def unread(self, data):
+        self._buffer[:0] = data
+
+
+def _zip64_sizes(extra, compressed_size, uncompressed_size):
+    position = 0
+    while position + 4 <= len(extra):
+        field_id, field_size = struct.unpack_from('<HH', extra, position)
+        if field_id == ZIP64_EXTRA_FIELD_ID:
+            values = struct.unpack_from(f'<{field_size // 8}Q', extra, position + 4)
+            index = 0
+            # Only the sizes saturated in the local header are present, uncompressed first
+            if uncompressed_size == 0xFFFFFFFF:
+                uncompressed_size = values[index]
+                index += 1
+            if compressed_size == 0xFFFFFFFF:
+                compressed_size = values[index]
+            return compressed_size, uncompressed_size, True
+        position += 4 + field_size
+    return compressed_size, uncompressed_size, False
+
+
+def _read_data_descriptor(reader, zip64):
+    signature = reader.read_exact(4)
+    if signature == DATA_DESCRIPTOR_SIGNATURE:
+        signature = reader.read_exact(4)
+    crc = struct.unpack('<I', signature)[0]
+    reader.read_exact(16 if zip64 else 8)
+    return crc
+
+
+def _member_data(reader, method, crc, compressed_size, has_data_descriptor, zip64, chunk_size):
+    computed_crc = 0
+    if method == METHOD_DEFLATED:
+        # Decompress until the deflate stream ends, the sizes may only follow in the data descriptor
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        while not decompressor.eof:
+            # Output is capped at chunk_size, the rest of the input is resumed from unconsumed_tail
+            chunk = decompressor.unconsumed_tail or reader.read_chunk(chunk_size)
+            if not chunk:
+                raise ValueError("Unexpected end of ZIP stream")
+            data = decompressor.decompress(chunk, chunk_size)
+            if decompressor.unused_data:
+                reader.unread(decompressor.unused_data)
+            if data:
+                computed_crc = zlib.crc32(data, computed_crc)
+                yield data
+    elif method == METHOD_STORED:
+        if has_data_descriptor and not compressed_size:
+            raise ValueError("Stored ZIP entries with a data descriptor cannot be streamed")
+        remaining = compressed_size
+        while remaining:
+            data = reader.read_chunk(min(chunk_size, remaining))
+            if not data:
+                raise ValueError("Unexpected end of ZIP stream")
+            remaining -= len(data)
+            computed_crc = zlib.crc32(data, computed_crc)
+            yield data
+    else:
+        raise ValueError(f"Unsupported ZIP compression method: {method}")
+
+    if has_data_descriptor:
+        crc = _read_data_descriptor(reader, zip64)
+    if computed_crc != crc:
+        raise ValueError("CRC mismatch in ZIP entry")
+
+
+def iter_members(chunks, chunk_size=CHUNK_SIZE):
+    # Walks the local file headers of a ZIP stream in order, the central directory is never needed.
+    # Each member's data must be consumed before moving on, unread data is skipped.
+    reader = _ChunkReader(chunks)
+    while True:
+        signature = reader.read(4)
+        if signature != LOCAL_FILE_HEADER_SIGNATURE:
+            # Central directory or end of the stream
+            return
+        (_, flags, method, _, _, crc, compressed_size, uncompressed_size,
+         name_length, extra_length) = struct.unpack('<HHHHHIIIHH', reader.read_exact(26))
+        name = reader.read_exact(name_length).decode('utf-8' if flags & FLAG_UTF8_NAME else 'cp437')
+        extra = reader.read_exact(extra_length)
+        if flags & FLAG_ENCRYPTED:
+            raise ValueError(f"Encrypted ZIP entry is not supported: {name}")
+        compressed_size, uncompressed_size, zip64 = _zip64_sizes(extra, compressed_size, uncompressed_size)
+
+        data = _member_data(reader, method, crc, compressed_size, bool(flags & FLAG_DATA_DESCRIPTOR), zip64, chunk_size)
+        yield name, data
+        for _ in data:
+            pass